@@ -1,14 +1,26 @@
 import os
 import random
-import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from slack_helper import *
 from generate_prompt import *
 from generate_image import *
+from generate_image import model as generation_model
 from utils import *
 from vars import *
 from SlackbotMessages import SlackBotMessages
-from reformat_image import resize_image
+from image_pool import render_outputs
+from reformat_image import normalize_image
 from dropbox_helper import *
+from workspace import JobWorkspace
+from model_cache import model_cache
+from model_catalog import model_catalog
+from generation_cache import generation_cache
+from openai_limiter import job_deadline
+from design_index import design_index, perceptual_hashes
+from metrics import metrics
+from timings import JobTimings
+from delivery import deliver
 
 messages = SlackBotMessages()
 
@@ -22,17 +34,82 @@ VALID_FLAGS = {
     "verbose",
     "help",
     "inject",
-    "attributes"
+    "attributes",
+    "fresh"
 }
 
 MODELS_FOLDER_ID = os.getenv("MODELS_FOLDER_ID")
 
+# memory: images are passed between stages as bytes and never touch the disk
+# disk: every stage writes its result into the job workspace and the next stage reads it back
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "memory")
+
+# Files of one mention processed at the same time, and files in flight across every job in the process
+JOB_FILE_CONCURRENCY = int(os.getenv("JOB_FILE_CONCURRENCY", 3))
+GLOBAL_FILE_CONCURRENCY = int(os.getenv("GLOBAL_FILE_CONCURRENCY", 6))
+
+file_slots = threading.BoundedSemaphore(GLOBAL_FILE_CONCURRENCY)
+
+# Runs the stages of a file that don't depend on each other, like fetching the model while the design downloads
+stage_pool = ThreadPoolExecutor(max_workers=GLOBAL_FILE_CONCURRENCY * 2, thread_name_prefix="stage")
+
 valid_channels = set(CHANNEL_MAP.keys())
 
-class EventHandler:
-    model_path = "./models/model.png"
+# Post the raw generation to Slack as a preview as soon as it exists, then encode the print master for
+# Dropbox and link it from the preview. Off sends the encoded copies to Slack and Dropbox together.
+PROGRESSIVE_DELIVERY = os.getenv("PROGRESSIVE_DELIVERY", "true").lower() in ("1", "true", "yes")
+
+# Destinations that receive an encoded copy, with progressive delivery Slack gets the raw generation instead
+ENCODED_DESTINATIONS = ["dropbox"] if PROGRESSIVE_DELIVERY else list(OUTPUT_PROFILES)
+
+# Profiles to encode for those destinations, destinations sharing a profile share the encode
+OUTPUT_ENCODINGS = {OUTPUT_PROFILES[d]: ENCODER_PROFILES[OUTPUT_PROFILES[d]] for d in ENCODED_DESTINATIONS}
+
+def output_filenames(base: str):
+    """
+        Names the copy of the output each destination receives after base, a name without extension.
+        The Dropbox print master keeps base, the other copies get their destination appended.
+    """
+    names = {}
+    for destination, profile in OUTPUT_PROFILES.items():
+        suffix = "" if destination == "dropbox" else f"-{destination}"
+        names[destination] = f"{base}{suffix}.{ENCODER_PROFILES[profile]['extension']}"
+    return names
+
+class SharedFile:
+    """
+        State of one file of a mention while it goes through the pipeline.
+        Each file gets its own so files of the same mention can be processed concurrently.
+    """
+    def __init__(self, file: dict, index: int, total: int):
+        self.file = file # The Slack file object
+        self.index = index # Position of the file in the message, starting at 1
+        self.total = total # Number of files in the message
+
+        self.input_filename = None
+        self.model_path = None
+        self.output_filename = None # Name of the print master
+        self.output_filenames = {} # destination -> name of its copy
+        self.preview_filename = None
+        self.dropbox_path = None # Where the print master ended up in Dropbox
+
+        # The images of the file, as bytes or as workspace paths in disk mode
+        self.input_image = None
+        self.model_image = None
+        self.outputs = {} # destination -> encoded output
+
+        self.design_hashes = None # Perceptual hashes of the design, for the near duplicate index
+        self.model_future = None # Model selection, started while the design downloads
+        self.preview_future = None # Preview post, runs while the print master is encoded
+        self.preview_ts = None # Slack message of the preview, updated as better frames come in
+        self.preview_file_id = None # Unshared Slack file the preview message shows
+        self.preview_lock = threading.Lock() # Held while the preview message is changed
+        self.final_preview = False # Set once the finished generation is on its way, later partial frames are dropped
+        self.preview_dropped = False # Set under preview_lock once the preview is taken down, nothing is posted after
+        self.timings = JobTimings()
 
-    def __init__(self, logger, event_type: str, channel_id: str, user: str, text: str, files: list):
+class EventHandler:
+    def __init__(self, logger, event_type: str, channel_id: str, user: str, text: str, files: list, thread_ts: str = None):
         if channel_id not in valid_channels:
             return 
         
@@ -41,7 +118,11 @@ class EventHandler:
         
         self.event_type = event_type # app_mention, file_shared, message, etc.
         self.channel_id = channel_id
-        self.input_filename = None
+        self.thread_ts = thread_ts # Thread of the mention, where previews and their links are posted
+        self.workspace = None # Scratch folders owned by this job, created when the job runs
+        self.upload_batch = None # Collects the Dropbox uploads of a multi-file mention
+        self.batch_files = {} # Requested Dropbox path -> SharedFile, for the files added to upload_batch
+        self.deadline = None # OpenAI calls of the job are given up after this time.monotonic() value
 
         self.dropbox_folder_id = CHANNEL_MAP[channel_id]
         
@@ -55,33 +136,26 @@ class EventHandler:
         self.help = False # User invokes help instructions from the bot
         self.inject = False # Allows the user to add text to the image generation prompt directly
         self.attributes = False # Whether a model is specified for the design.
+        self.fresh = False # Generates a new image even if this design, model and prompt were generated before
 
         self.attribute_params = ()
 
-        try:
-            # Save memory by removing any existing folder structures from the app
-            remove_directory_recursively("user_submitted_files")
-            remove_directory_recursively("image_outputs")
-            remove_directory_recursively("models")
-        except:
-            pass
-
-        self._mkdirs("user_submitted_files")
-        self._mkdirs("image_outputs")
-        self._mkdirs("models")
-
         self._set_flags()
 
     def handle_event(self):
         """
             Delegates the handling of the message to the specified function. 
         """
-        if self.event_type == "app_mention":
-            self.logger.info("Handling app_mention...")
-            self._handle_app_mention()
-        elif self.event_type == "file_shared":
-            self.logger.info("Handling file shared...")
-            self._handle_files_shared()    
+        self.deadline = job_deadline()
+        with JobWorkspace() as self.workspace:
+            self.logger.info(f"Working in {self.workspace.path}")
+
+            if self.event_type == "app_mention":
+                self.logger.info("Handling app_mention...")
+                self._handle_app_mention()
+            elif self.event_type == "file_shared":
+                self.logger.info("Handling file shared...")
+                self._handle_files_shared()
 
     def _handle_app_mention(self):
         """
@@ -91,6 +165,13 @@ class EventHandler:
             Initiates the process for file download and image generation.
             If no file is submitted it invokes the direct prompt image generator.
         """
+        if self._read_mention():
+            self._handle_files_shared()
+
+    def _read_mention(self):
+        """
+            Answers the flags of the mention and returns whether it came with files to work on.
+        """
         if self.help: # If the help flag is present
             message = messages.HelpMessage(self.user)
             send_message(self.channel_id, message)
@@ -99,63 +180,152 @@ class EventHandler:
             self.attribute_params = get_attributes(self.text)
             print(self.attribute_params)
 
-        if self.files: # The user has submitted a file to be edited
-            self._handle_files_shared()
-        else: # The user has not submitted a file to be edited
+        if not self.files: # The user has not submitted a file to be edited
             send_message(self.channel_id, messages.FilesNotShared)
+            return False
+        return True
 
     def _handle_files_shared(self):
         """
             Sends each file in the batch off to be handled by the file handler.
-            Treats a batch continuously.
+            Up to JOB_FILE_CONCURRENCY files of the batch are processed at the same time and each
+            result is sent back as soon as it is ready.
         """
-        for file in self.files:
-            self._handle_file_shared(file)
+        shared_files = self._shared_files()
+
+        if len(shared_files) == 1:
+            self._handle_file_shared(shared_files[0])
+            return
+
+        with ThreadPoolExecutor(max_workers=min(JOB_FILE_CONCURRENCY, len(shared_files))) as pool:
+            for future in [pool.submit(self._handle_file_shared, shared) for shared in shared_files]:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"File could not be processed: {e}")
+
+        if self.upload_batch:
+            self._commit_upload_batch()
         return
 
-    def _handle_file_shared(self, file):
+    def _shared_files(self):
+        """
+            Returns the SharedFile of every file of the mention.
+            Multi-file batches are committed to Dropbox with one call once every file is done.
+        """
+        shared_files = [SharedFile(file, i + 1, len(self.files)) for i, file in enumerate(self.files)]
+        if len(shared_files) > 1:
+            self.upload_batch = UploadBatch(self.dropbox_folder_id)
+        return shared_files
+
+    def _commit_upload_batch(self):
+        """
+            Commits the outputs of a multi-file batch to Dropbox and reports the result.
+        """
+        response = self.upload_batch.commit()
+        failures = [e for e in response.get("entries", []) if e.get(".tag") != "success"]
+
+        if PROGRESSIVE_DELIVERY:
+            for entry in response.get("entries", []):
+                shared = self.batch_files.get(entry.get("requested_path"))
+                if shared and entry.get(".tag") == "success":
+                    shared.dropbox_path = entry["path_display"]
+                    self._link_preview(shared)
+
+        if response.get("error") or failures:
+            send_message(self.channel_id, messages.DropboxUploadError(response.get("error") or failures))
+        elif response.get("entries") and not PROGRESSIVE_DELIVERY:
+            send_message(self.channel_id, messages.DropboxSuccessful)
+
+    def _handle_file_shared(self, shared: SharedFile):
         """
             This process downloads the file from slack through the channel.
             It then uploads the image along with the prompt to the OpenAI image generation API.
             The file is then sent through the slack channel. 
+            Waits for a free slot so the process never works on more than GLOBAL_FILE_CONCURRENCY files.
+        """
+        with file_slots:
+            if self._receive_design(shared):
+                self._facilitate_output(shared, os.path.splitext(os.path.basename(shared.input_filename))[0])
+            self.logger.info(f"Timings for file {shared.index} of {shared.total}:\n{shared.timings.report()}")
+
+    def _receive_design(self, shared: SharedFile):
         """
-        if file:
-            ext = file.get("filetype").lower()
+            Downloads and normalizes the design while the model is selected on the stage pool.
+            Returns False once the user has been told the download failed.
+        """
+        if shared.file:
+            ext = shared.file.get("filetype").lower()
         else:
             ext = "png"
-        
-        self._get_file_from_user(file, ext)
-        self._facilitate_output(self.input_filename.split('/')[-1][:-4])
 
-    def _facilitate_output(self, input_filename):
+        # The model doesn't depend on the design, fetch it while the design downloads
+        shared.model_future = stage_pool.submit(self._select_model, shared, self._model_attributes())
+        
+        try:
+            with shared.timings.stage("download"):
+                self._get_file_from_user(shared, ext)
+        except SlackDownloadError as e:
+            # Nothing has been spent on this file yet, tell the user and move on
+            send_message(self.channel_id, messages.DownloadError(e))
+            self.logger.info(f"Download failed: {e}")
+            return False
+
+        with shared.timings.stage("normalize", after=("download",)):
+            self._normalize_input(shared)
+        return True
+
+    def _facilitate_output(self, shared: SharedFile, input_filename):
         """
             Handles the naming of the output file, sending confirmation messages.
             Calls the generate image and send function. 
         """
-        # Unconditionally set the extension to png if it is being generated
-        output_filename = f"image_outputs/gen_image_{input_filename}.png" 
-        send_message(self.channel_id, messages.GeneratorConfirmation(output_filename.split('/')[-1]))
+        self._name_outputs(shared, input_filename)
+        self._generate_image_and_send(shared)
+
+    def _name_outputs(self, shared: SharedFile, input_filename):
+        """
+            Names the outputs of the file in the workspace after its input and tells the user what is coming.
+        """
+        shared.output_filenames = output_filenames(os.path.join(self.workspace.path, "outputs", f"gen_image_{input_filename}"))
+        shared.output_filename = shared.output_filenames["dropbox"]
+        shared.preview_filename = os.path.join(self.workspace.path, "outputs", f"gen_image_{input_filename}-preview.png")
+        send_message(self.channel_id, messages.GeneratorConfirmation(os.path.basename(shared.output_filename)))
 
         if self.verbose:
             send_message(self.channel_id, messages.VerboseConfirmation)
 
-        self._generate_image_and_send(output_filename)
-
-    def _get_file_from_user(self, file, ext):
+    def _get_file_from_user(self, shared: SharedFile, ext):
         """
             Function handles trying to download the file that a user attached to the message.
             As a side effect it generates the input filename for use later. 
         """
         # Name the file that will be saved from the User's message
-        now = datetime.datetime.now()
-        self.input_filename = f"user_submitted_files/{now.strftime('%Y-%m-%d-%H-%M-%S')}.{ext}"
+        shared.input_filename = self.workspace.new_file("inputs", ext)
 
-        # From slack helper
-        download_slack_file(file["url_private"], self.input_filename)
+        # From slack helper, streamed straight into memory or into the workspace
+        if PIPELINE_MODE == "disk":
+            shared.input_image = download_slack_file(shared.file["url_private"], shared.input_filename)
+        else:
+            shared.input_image = download_slack_file(shared.file["url_private"])
         if self.verbose:
             send_message(self.channel_id, messages.Download)
      
-    def _handle_image_prompt_and_generation(self, output_filename):
+    def _normalize_input(self, shared: SharedFile):
+        """
+            Shrinks the design to what the image model can use, see reformat_image.normalize_image.
+            A design Pillow can't read is sent as it is and left to OpenAI to judge.
+        """
+        try:
+            normalized = normalize_image(shared.input_image)
+        except Exception as e:
+            print(f"Design could not be normalized, sending it as it is: {e}")
+            return
+
+        metrics.incr("normalize.designs")
+        shared.input_image = self._keep(shared.input_filename, normalized)
+
+    def _handle_image_prompt_and_generation(self, shared: SharedFile):
         """"
             Generates the image prompt and the generation of an Ai generated image.
             It handles the cases of prompt-only and image-edit.
@@ -165,26 +335,53 @@ class EventHandler:
                     to try to edit the given image and return a suitable design.
         """
         try:
-            generated_prompt = self._generate_prompt()
-            generated_image = self._generate_image(generated_prompt)
-
-            # Reformat the image to proper dimensions and specs
-            generated_image = resize_image(generated_image)
-            
-            self.logger.info("Image Resized")
-            if self.verbose:
-                send_message(self.channel_id, messages.ImageResized)
-
-            generated_image.save(output_filename)
-            if self.verbose:
-                send_message(self.channel_id, messages.TrySending)
-            self.logger.info(f"Generated image saved to {output_filename}")
+            with shared.timings.stage("prompt"):
+                generated_prompt = self._generate_prompt()
+            generated_image = self._generate_image(shared, generated_prompt)
+            self._image_generated(shared, generated_image)
+
+            # Reformat the image to proper dimensions and encode the copy of every destination, in parallel in the image pool
+            resize_stats = {}
+            with shared.timings.stage("encode", after=("generate",)):
+                settings = CHANNEL_RESIZE_SETTINGS.get(self.channel_id)
+                encoded = render_outputs(generated_image, OUTPUT_ENCODINGS, settings, resize_stats)
+            self._keep_outputs(shared, encoded, resize_stats)
 
             return 200
         
         except Exception as e:
-            send_message(self.channel_id, messages.GeneratorError(e))
-            print(f"Image generation could not be completed. {e}")
+            self._generation_failed(shared, e)
+
+    def _image_generated(self, shared: SharedFile, generated_image):
+        """
+            Tells a verbose user the image is ready and, with progressive delivery, starts posting the preview.
+        """
+        if self.verbose: 
+            send_message(self.channel_id, messages.ImageGenerated)
+
+        if PROGRESSIVE_DELIVERY:
+            # The user gets to see the result while the print master is being made
+            shared.preview_future = stage_pool.submit(self._post_preview, shared, generated_image)
+
+    def _keep_outputs(self, shared: SharedFile, encoded: dict, resize_stats: dict):
+        """
+            Holds on to the encoded copy of every destination, given the outputs of render_outputs.
+        """
+        for destination in ENCODED_DESTINATIONS:
+            encoding = encoded[OUTPUT_PROFILES[destination]]
+            shared.outputs[destination] = self._keep(shared.output_filenames[destination], encoding)
+        
+        self.logger.info(f"Image Resized: {resize_stats}")
+        if self.verbose:
+            send_message(self.channel_id, messages.ImageResized)
+        if self.verbose:
+            send_message(self.channel_id, messages.TrySending)
+        self.logger.info(f"Generated image saved to {shared.output_filename}")
+
+    def _generation_failed(self, shared: SharedFile, e):
+        self._drop_preview(shared)
+        send_message(self.channel_id, messages.GeneratorError(e))
+        print(f"Image generation could not be completed. {e}")
 
     def _generate_prompt(self):
         """
@@ -210,28 +407,41 @@ class EventHandler:
         
         return generated_prompt
     
-    def _select_model(self, attributes: tuple):
+    def _select_model(self, shared: SharedFile, attributes: tuple):
+        with shared.timings.stage("model"):
+            self._fetch_model(shared, attributes)
+
+    def _fetch_model(self, shared: SharedFile, attributes: tuple):
         # sex, color
         s, c = attributes
 
         # Start building the model path
         if not s:
-            s = random.choice(["female", "male"])
+            s = random.choice(MODEL_ATTRIBUTES["sex"])
 
         if not c:
-            c = random.choice(["white", "black", "red", "blue"])
-        
+            c = random.choice(MODEL_ATTRIBUTES["shirt-color"])
+
+        shared.model_path = self.workspace.new_file("models", "png")
+
+        entry = model_catalog.select(s, c)
+        if entry:
+            shared.model_image = self._keep(shared.model_path, model_cache.get_normalized(entry["path_display"], entry["content_hash"]))
+            print(f"Selected model {entry['path_display']}")
+            return
+
+        # The catalog is still being built or Dropbox could not be reached, list the folder directly
         model_path = f"/{s}/{c}/"
 
         number_suitable_files = count_files_in_subfolder(MODELS_FOLDER_ID, model_path)['file_count']
         endfile = f"{random.randrange(1, number_suitable_files+1)}.png" # Get the endfile path, all files are numbered
 
-        res = download_file_from_shared_folder(MODELS_FOLDER_ID, model_path+endfile, self.model_path)
-        print(f"Downloading Model from Dropbox: {res}")
+        shared.model_image = self._keep(shared.model_path, model_cache.get_normalized(model_path+endfile))
+        print(f"Selected model {model_path+endfile}")
     
-    def _generate_image(self, generated_prompt):
+    def _model_attributes(self):
         """
-            Makes the call to generate the image. 
+            Returns the (sex, shirt-color) the user asked for, with "" for anything left to chance.
         """
         ordered_attributes = ["", ""]
         if self.attributes:
@@ -240,50 +450,255 @@ class EventHandler:
                     ordered_attributes[0] = a
                 elif a in MODEL_ATTRIBUTES["shirt-color"]:
                     ordered_attributes[1] = a # Ordered attributes should be (sex, shirt-color)
+        return tuple(ordered_attributes)
 
-        # Generate the model file
-        self._select_model(tuple(ordered_attributes))
+    def _generate_image(self, shared: SharedFile, generated_prompt):
+        """
+            Makes the call to generate the image. 
+        """
+        # Wait for the model file that was selected while the design downloaded
+        shared.model_future.result()
 
-        # Make a call to OpenAi image generation model based on the prompt
-        generated_image = edit_image(generated_prompt, self.input_filename, self.model_path)
+        with shared.timings.stage("generate", after=("normalize", "model", "prompt")):
+            key, generated_image = self._find_generation(shared, generated_prompt)
 
-        if self.verbose: 
-            send_message(self.channel_id, messages.ImageGenerated)
+            if generated_image is None:
+                # Make a call to OpenAi image generation model based on the prompt
+                generated_image = edit_image(generated_prompt, shared.input_image, shared.model_image,
+                                             self.deadline, self._partial_handler(shared))
+                self._store_generation(shared, generated_prompt, key, generated_image)
         
         return generated_image
+
+    def _find_generation(self, shared: SharedFile, generated_prompt):
+        """
+            Looks for an earlier result of this design, model and prompt, or of a design that looks the same.
+            Returns the generation cache key of the file and the result, or None for the result.
+        """
+        key = generation_cache.key(shared.input_image, shared.model_image, generated_prompt, generation_model)
+        generated_image = None if self.fresh else generation_cache.get(key)
+
+        if generated_image is None:
+            generated_image = self._reuse_near_duplicate(shared, generated_prompt)
+        else:
+            self.logger.info(f"Reusing the generation cached under {key}")
+        return key, generated_image
+
+    def _store_generation(self, shared: SharedFile, generated_prompt, key, generated_image):
+        generation_cache.put(key, generated_image)
+        if shared.design_hashes:
+            design_index.add(shared.design_hashes, self._design_variant(generated_prompt), key)
+
+    def _partial_handler(self, shared: SharedFile):
+        """
+            Returns the on_partial callback for edit_image, which hands partial frames to the stage pool
+            so the stream is never held up by Slack, or None without progressive delivery.
+        """
+        if not PROGRESSIVE_DELIVERY:
+            return None
+        return lambda index, image: stage_pool.submit(self._post_partial, shared, index, image)
     
-    def _generate_image_and_send(self, output_filename):
+    def _design_variant(self, generated_prompt):
+        return design_index.variant(generated_prompt, *self._model_attributes(), generation_model)
+
+    def _reuse_near_duplicate(self, shared: SharedFile, generated_prompt):
+        """
+            Returns the result of a recent design that looks the same as this one, or None.
+            Hashes the design on the way so it can be indexed once it is generated.
+        """
+        if not design_index:
+            return None
+
+        try:
+            shared.design_hashes = perceptual_hashes(shared.input_image)
+        except Exception as e:
+            print(f"Design could not be hashed: {e}")
+            return None
+
+        if self.fresh:
+            return None
+
+        match = design_index.find(shared.design_hashes, self._design_variant(generated_prompt))
+        # The exact lookup already counted a miss, the reuse is counted under design_index.reused
+        generated_image = match and generation_cache.get(match["result_key"], count=False)
+        if not generated_image:
+            return None
+
+        self.logger.info(f"Design matches an earlier one: {match}")
+        metrics.incr("design_index.reused")
+        send_message(self.channel_id, messages.NearDuplicate)
+        return generated_image
+
+    def _generate_image_and_send(self, shared: SharedFile):
         """
             Handles the end stage of the image generation process. It makes a call to the image prompter and generator.
             Handles the resizing and sends the message. 
             This function acts as an intermediary between the caller and the _handle_image_prompt_and_generation function.
         """
-        if self._handle_image_prompt_and_generation(output_filename) == 200:
-            # Send the output to dropbox
+        if self._handle_image_prompt_and_generation(shared) == 200:
+            self._deliver(shared)
+
+    def _deliver(self, shared: SharedFile):
+        """
+            Fans the outputs out to their destinations, links the preview and removes the local files.
+        """
+        destinations = {
+            "dropbox": lambda: self._timed(shared, "dropbox_upload", self._upload_to_dropbox, shared)
+        }
+
+        if not PROGRESSIVE_DELIVERY:
+            # Fan the encoded output out to Slack and Dropbox at the same time
             send_message(self.channel_id, messages.AttemptingDropbox)
+            destinations["slack"] = lambda: self._timed(shared, "slack_upload", send_file, self.channel_id,
+                                                        shared.output_filenames["slack"],
+                                                        messages.FileResult(shared.index, shared.total),
+                                                        content=self._content(shared.outputs["slack"]))
+
+        report = deliver(destinations, stage_pool, on_result=self._report_delivery)
 
-            try:
-                response = upload_to_shared_folder(output_filename, self.dropbox_folder_id)
-                if response.get("error"):
-                    send_message(self.channel_id, messages.DropboxUploadError(response))
-                else:
-                    send_message(self.channel_id, messages.DropboxSuccessful)
-            except Exception as e:
-                print(f"Dropbox file upload failed: {e}")
+        # Batch files are linked once the batch is committed
+        if PROGRESSIVE_DELIVERY and report.ok and not self.upload_batch:
+            shared.dropbox_path = report.results["dropbox"]["response"]["dropbox_path"]
+            self._link_preview(shared)
 
-            send_file(self.channel_id, output_filename)
-            self._cleanup(output_filename)
+        self.logger.info(f"Delivery of file {shared.index} of {shared.total}: {report}")
+        self._cleanup(shared)
 
-    def _mkdirs(self, folder_path):
+    def _show_preview(self, shared: SharedFile, image, message):
         """
-            Initializes the necessary folders used for image saving and generation.
+            Shows image in the preview message, posting the message the first time, and deletes the
+            file it showed before. Frames are uploaded without being shared, so replacing one leaves
+            no trace in the channel and only the first post notifies anyone. Returns whether it worked.
         """
-        # Check if the folder exists
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-            self.logger.info(f"Created directory: {folder_path}")
-        else:
-            self.logger.info(f"Directory already exists: {folder_path}")
+        upload = upload_file(shared.preview_filename, image)
+        if upload.get("error"):
+            return False
+
+        ts = post_image(self.channel_id, message, upload["file_id"], shared.preview_ts, self.thread_ts)
+        if not ts:
+            delete_file(upload["file_id"])
+            return False
+
+        previous, shared.preview_ts, shared.preview_file_id = shared.preview_file_id, ts, upload["file_id"]
+        if previous:
+            delete_file(previous)
+        return True
+
+    def _post_partial(self, shared: SharedFile, index, image):
+        """
+            Shows a partial frame of the generation in the preview message.
+            A frame arriving while the one before is still uploading is dropped, the next one will do.
+        """
+        if shared.final_preview or not shared.preview_lock.acquire(blocking=False):
+            metrics.incr("generation.partials_dropped")
+            return
+
+        try:
+            if shared.final_preview:
+                return
+
+            if self._show_preview(shared, image, messages.PartialPreview(shared.index, shared.total, index + 1)):
+                metrics.incr("generation.partials_posted")
+                metrics.set_gauge("generation.time_to_first_preview_ms", shared.timings.mark("first_preview", after=("prompt",)))
+        finally:
+            shared.preview_lock.release()
+
+    def _drop_preview(self, shared: SharedFile):
+        """
+            Stops showing partial frames and takes the preview message down, waiting for an update in flight.
+        """
+        shared.final_preview = True
+        with shared.preview_lock:
+            shared.preview_dropped = True
+            if shared.preview_ts:
+                delete_message(self.channel_id, shared.preview_ts)
+                delete_file(shared.preview_file_id)
+                shared.preview_ts = shared.preview_file_id = None
+
+    def _post_preview(self, shared: SharedFile, generated_image):
+        """
+            Shows the generation, as it came from the model, in the preview message,
+            in place of the partial frame shown while the generation streamed in.
+        """
+        shared.final_preview = True
+        with shared.preview_lock:
+            if shared.preview_dropped:
+                # The job failed before this got the lock, don't post a result next to the error
+                return
+            with shared.timings.stage("preview", after=("generate",)):
+                shown = self._show_preview(shared, generated_image, messages.PreviewResult(shared.index, shared.total))
+
+        if not shown:
+            # Don't leave a sketch up as if it were the result
+            self._drop_preview(shared)
+            return
+
+        # Without partial frames, or when none made it, the final preview is also the first
+        metrics.set_gauge("generation.time_to_first_preview_ms", shared.timings.mark("first_preview", after=("prompt",)))
+        metrics.set_gauge("generation.time_to_final_ms", shared.timings.mark("final_preview", after=("preview",)))
+
+    def _link_preview(self, shared: SharedFile):
+        """
+            Adds the Dropbox link of the print master to the preview message,
+            or posts it on its own if the preview message can't be edited.
+        """
+        shared.preview_future.result()
+
+        link = create_shared_link(self.dropbox_folder_id, shared.dropbox_path)
+        if link.get("error"):
+            print(f"Could not link {shared.dropbox_path}: {link}")
+            send_message(self.channel_id, messages.DropboxSuccessful, self.thread_ts)
+            return
+
+        message = messages.MasterReady(shared.index, shared.total, link["url"], os.path.basename(shared.dropbox_path))
+        if not (shared.preview_ts and post_image(self.channel_id, message, shared.preview_file_id, shared.preview_ts)):
+            send_message(self.channel_id, message, self.thread_ts)
+
+    def _timed(self, shared: SharedFile, stage, fn, *args, **kwargs):
+        with shared.timings.stage(stage, after=("encode",)):
+            return fn(*args, **kwargs)
+
+    def _upload_to_dropbox(self, shared: SharedFile):
+        """
+            Uploads the output to the channel's Dropbox folder, or adds it to the batch of a multi-file mention.
+        """
+        if self.upload_batch:
+            response = self.upload_batch.add(shared.output_filename, self._content(shared.outputs["dropbox"]))
+            if not response.get("error"):
+                self.batch_files[response["dropbox_path"]] = shared
+            return response
+        return upload_to_shared_folder(shared.output_filename, self.dropbox_folder_id, self._content(shared.outputs["dropbox"]))
+
+    def _report_delivery(self, destination, result):
+        """
+            Tells the user how the Dropbox upload went. The Slack upload speaks for itself.
+        """
+        if destination != "dropbox":
+            return
+
+        if not result["ok"]:
+            send_message(self.channel_id, messages.DropboxUploadError(result["error"]))
+        elif not self.upload_batch and not PROGRESSIVE_DELIVERY:
+            send_message(self.channel_id, messages.DropboxSuccessful)
+
+    def _keep(self, path, data):
+        """
+            Holds on to the result of a stage. In memory mode the bytes are returned as they are,
+            in disk mode they are written to path in the workspace and the path is returned.
+        """
+        if PIPELINE_MODE != "disk" or data is None:
+            return data
+
+        with open(path, "wb") as f:
+            f.write(data)
+        metrics.incr("pipeline.disk_writes")
+        return path
+
+    def _content(self, image):
+        """
+            Returns the bytes of an image kept by _keep, or None if it lives on disk.
+        """
+        return image if isinstance(image, bytes) else None
 
     def _set_flags(self):
         """
@@ -296,17 +711,23 @@ class EventHandler:
             if flag in self.flags:
                 setattr(self, flag, True) 
 
-    def _cleanup(self, output_filename):
+    def _cleanup(self, shared: SharedFile):
         """
             Removes the images that have been saved locally and temporarily.
             Removes the input image files and the generated output files.
+            Drops the buffers of the file so they can be freed before the rest of the batch is done.
         """
+        shared.input_image = None
+        shared.model_image = None
+        shared.outputs = {}
+
         # Remove stored slack image
-        if self.input_filename and os.path.exists(self.input_filename):
-            os.remove(self.input_filename)
+        if shared.input_filename and os.path.exists(shared.input_filename):
+            os.remove(shared.input_filename)
    
-        if output_filename and os.path.exists(output_filename):
-            os.remove(output_filename)
+        for output_filename in shared.output_filenames.values():
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
 
 
 
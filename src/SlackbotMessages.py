@@ -15,10 +15,15 @@ class SlackBotMessages:
     SeriesError = "When using the --series flag you must specify one or more variable arguments. E.g. {1, 2, 3, 4} somewhere in your message. You must also only include a single image or prompt."
     DropboxError = "File could not be uploaded to DropBox"
     FilesNotShared = "You must share file(s) for an ad to be generated."
+    NearDuplicate = "This design looks like one I've made an image for recently, so I'm reusing that image. Add --fresh to your message for a new one."
+    QueueFull = "I'm working on a lot of requests right now. Please try again in a few minutes."
  
-    def GeneratorError(e):
+    def GeneratorError(self, e):
        return f"Something went wrong with ImageGeneratorBot :( Image request did not pass the vibe check. {e}"
     
+    def DownloadError(self, e):
+       return f"I couldn't use the file you shared: {e}"
+
     def DropboxUploadError(self, e):
        return f"There was an error uploading to Dropbox: {e}"
 
@@ -31,7 +36,22 @@ class SlackBotMessages:
                 "\t--verbose: Will give you feedback for most of the operations so that you know exactly what I'm doing\n"
                 "\t--inject: Allows you to add a message to your prompt. Just type your message into the box following the flag.\n"
                 "\t--series: Allows you to create a series of images from a single image or prompt\n"
+                "\t--fresh: Makes a new image even if I have made one from the same file before\n"
                 "I'll handle the rest and create your AI-generated image! :art:")
 
+    def FileResult(self, index, total):
+        if total == 1:
+            return "Here’s an AI-generated Image! 🎨"
+        return f"Here’s an AI-generated Image for file {index} of {total}! 🎨"
+
+    def PreviewResult(self, index, total):
+        return f"{self.FileResult(index, total)} This is a preview, the print master is on its way to Dropbox... :hourglass_flowing_sand:"
+
+    def PartialPreview(self, index, total, frame):
+        return f"{self.FileResult(index, total)} Still drawing, this is sketch {frame}... :art:"
+
+    def MasterReady(self, index, total, link, filename):
+        return f"{self.FileResult(index, total)} The print master is in Dropbox: <{link}|{filename}>"
+
     def GeneratorConfirmation(self, filename):
         return f"Slack Bot will send a file with the name {filename} here... :hourglass_flowing_sand:"
\ No newline at end of file
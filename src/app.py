@@ -1,25 +1,22 @@
 import os
 from flask import Flask, request, jsonify
-from EventHandler import EventHandler
+from EventHandler import EventHandler, valid_channels
+from SlackbotMessages import SlackBotMessages
+from job_queue import JobQueue
+from model_catalog import model_catalog
+from dedup import event_key, make_dedup_store
+from metrics import metrics
+from slack_helper import send_message
 import logging
 import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
-if os.path.exists("app.log"):
-    os.remove("app.log")
-
-# Basic config
-logging.basicConfig(
-    filename="app.log",
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
 app = Flask(__name__)
 
+messages = SlackBotMessages()
+
 events_of_interest = set({"app_mention"})
 
 # YOUR APP credentials
@@ -27,10 +24,64 @@ APP_ID = os.getenv("APP_ID")
 APP_SECRET = os.getenv("APP_SECRET")
 TEMP_TOKEN = os.getenv("TEMP_TOKEN")
 
+def run_job(payload):
+    """
+        Runs a queued Slack event on one of the job queue workers.
+    """
+    event_handler = EventHandler(app.logger, **payload)
+    event_handler.handle_event()
+
+# threads: a pool of JOB_WORKERS threads each run one job at a time
+# async: one event loop keeps many jobs in flight, see async_engine.py
+JOB_ENGINE = os.getenv("JOB_ENGINE", "threads")
+
+# Set by start_services
+job_queue = None
+dedup_store = None
+
+def start_services():
+    """
+        Sets up the log and starts the job engine, the model catalog sync and the dedup store.
+        Runs once per serving process, from __main__ or gunicorn's post_worker_init hook (gunicorn.conf.py),
+        and never on import: the image pool spawns its processes, and they import the main module again.
+    """
+    global job_queue, dedup_store
+    if job_queue is not None:
+        return
+
+    if os.path.exists("app.log"):
+        os.remove("app.log")
+
+    # Basic config
+    logging.basicConfig(
+        filename="app.log",
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    if JOB_ENGINE == "async":
+        from async_engine import AsyncJobEngine
+
+        job_queue = JobQueue(run_job, app.logger, workers=0)
+        AsyncJobEngine(job_queue, app.logger).start()
+    else:
+        job_queue = JobQueue(run_job, app.logger)
+        job_queue.start()
+
+    # Index and preload the model images in the background so jobs don't have to fetch them
+    model_catalog.start()
+
+    dedup_store = make_dedup_store()
+
 @app.route("/")
 def hello():
     return "Hello from Railway!"
 
+@app.route("/metrics")
+def get_metrics():
+    return jsonify(metrics.snapshot())
+
 @app.route('/slack/events', methods=['POST', 'GET'])
 def slack_events():
     data = request.get_json()
@@ -49,15 +100,42 @@ def slack_events():
         channel_id = event.get("channel")
         files = event.get("files")
 
-        if event_type in events_of_interest:
-            event_handler = EventHandler(app.logger, event_type, channel_id, user, text, files)
+        # Only validate and enqueue here, everything else happens on the job workers
+        # so Slack gets its ack well inside the 3 second deadline.
+        if event_type in events_of_interest and channel_id in valid_channels:
+            retry_num = request.headers.get("X-Slack-Retry-Num")
+            if retry_num:
+                metrics.incr("events.retries_received")
+
+            # Slack redelivers events it thinks we missed, ack those without starting work again
+            event_id = data.get("event_id")
+            if event_id and not dedup_store.claim(event_key(event_id, files)):
+                metrics.incr("events.duplicates_suppressed")
+                app.logger.info(f"Dropping duplicate event {event_id} (retry {retry_num})")
+                return '', 200
+
             app.logger.info(f"{event_type} message from {user}: {text}, channel: {channel_id}")
 
-            # Launch background thread
-            threading.Thread(target=event_handler.handle_event).start()
+            job_id = job_queue.enqueue({
+                "event_type": event_type,
+                "channel_id": channel_id,
+                "user": user,
+                "text": text,
+                "files": files,
+                # Previews are posted in the thread of the mention, or the thread it was made in
+                "thread_ts": event.get("thread_ts") or event.get("ts")
+            })
+
+            if job_id is None:
+                # Queue is full, let the user know without holding up the response to Slack
+                app.logger.info(f"Job queue is full, rejecting {event_type} from {user}")
+                threading.Thread(target=send_message, args=(channel_id, messages.QueueFull)).start()
+            else:
+                app.logger.info(f"Queued job {job_id}")
 
     return '', 200
 
 if __name__ == "__main__":
+    start_services()
     port = int(os.environ.get("PORT", 5000))  # Default to 5000 if not set
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
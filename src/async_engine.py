@@ -0,0 +1,163 @@
+import os
+import asyncio
+import threading
+from EventHandler import (
+    EventHandler,
+    SharedFile,
+    JOB_FILE_CONCURRENCY,
+    GLOBAL_FILE_CONCURRENCY,
+    OUTPUT_ENCODINGS
+)
+from generate_image import edit_image_async
+from image_pool import render_outputs_async
+from workspace import JobWorkspace
+from openai_limiter import job_deadline
+from job_queue import JOB_POLL_INTERVAL
+from vars import CHANNEL_RESIZE_SETTINGS
+from metrics import metrics
+
+__all__ = ["AsyncJobEngine"]
+
+ASYNC_JOB_CONCURRENCY = int(os.getenv("ASYNC_JOB_CONCURRENCY", 100))
+
+class AsyncJobEngine:
+    """
+        Runs queued jobs on an asyncio event loop instead of the worker threads.
+        The OpenAI generation, which keeps a job waiting for minutes, and the resize and encode in
+        the image pool are awaited, so one process can keep up to ASYNC_JOB_CONCURRENCY jobs in flight.
+        Every other stage is the EventHandler one, run in a thread, so both engines behave the same.
+        Enabled with JOB_ENGINE=async.
+    """
+    def __init__(self, job_queue, logger, concurrency=ASYNC_JOB_CONCURRENCY):
+        self.job_queue = job_queue
+        self.logger = logger
+        self.concurrency = concurrency
+
+        self._thread = None
+        self._tasks = set() # Keeps running jobs referenced until they finish
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=asyncio.run, args=(self._main(),), name="async-engine", daemon=True)
+        self._thread.start()
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # The loop's counterpart of EventHandler.file_slots, a process runs one engine or the other.
+        # It only covers the download and normalize, and the encode, waiting on OpenAI takes no slot.
+        self._file_slots = asyncio.Semaphore(GLOBAL_FILE_CONCURRENCY)
+        self.job_queue.add_listener(lambda: loop.call_soon_threadsafe(self._wakeup.set))
+        await self._dispatch()
+
+    async def _dispatch(self):
+        """
+            Claims jobs from the queue while there is room for more in flight.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+
+        while True:
+            await slots.acquire()
+            job = await asyncio.to_thread(self.job_queue.claim)
+
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            task = asyncio.create_task(self._run_job(*job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+            metrics.set_gauge("async_engine.jobs_in_flight", len(self._tasks))
+
+    async def _run_job(self, job_id, payload):
+        self.logger.info(f"Starting job {job_id}")
+        try:
+            await self._handle_event(EventHandler(self.logger, **payload))
+            await asyncio.to_thread(self.job_queue.finish, job_id)
+            self.logger.info(f"Finished job {job_id}")
+        except Exception as e:
+            await asyncio.to_thread(self.job_queue.finish, job_id, str(e))
+            self.logger.info(f"Job {job_id} failed: {e}")
+
+    async def _handle_event(self, handler: EventHandler):
+        """
+            Async counterpart of EventHandler.handle_event for app mentions.
+        """
+        if handler.event_type != "app_mention":
+            return
+        handler.deadline = job_deadline()
+
+        with JobWorkspace() as handler.workspace:
+            self.logger.info(f"Working in {handler.workspace.path}")
+            if not await asyncio.to_thread(handler._read_mention):
+                return
+
+            job_files = asyncio.Semaphore(JOB_FILE_CONCURRENCY)
+            results = await asyncio.gather(*(
+                self._handle_file(handler, shared, job_files) for shared in handler._shared_files()
+            ), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"File could not be processed: {result}")
+
+            if handler.upload_batch:
+                await asyncio.to_thread(handler._commit_upload_batch)
+
+    async def _handle_file(self, handler: EventHandler, shared: SharedFile, job_files):
+        """
+            Async counterpart of EventHandler._handle_file_shared.
+            Unlike the thread engine, the global file slot is only held for the CPU and disk stages,
+            so files waiting on OpenAI are capped by ASYNC_JOB_CONCURRENCY and JOB_FILE_CONCURRENCY alone.
+        """
+        async with job_files:
+            async with self._file_slots:
+                received = await asyncio.to_thread(handler._receive_design, shared)
+            if not received:
+                return
+
+            input_filename = os.path.splitext(os.path.basename(shared.input_filename))[0]
+            await asyncio.to_thread(handler._name_outputs, shared, input_filename)
+
+            try:
+                with shared.timings.stage("prompt"):
+                    prompt = await asyncio.to_thread(handler._generate_prompt)
+                generated_image = await self._generate_image(handler, shared, prompt)
+                await asyncio.to_thread(handler._image_generated, shared, generated_image)
+
+                resize_stats = {}
+                async with self._file_slots:
+                    with shared.timings.stage("encode", after=("generate",)):
+                        settings = CHANNEL_RESIZE_SETTINGS.get(handler.channel_id)
+                        encoded = await render_outputs_async(generated_image, OUTPUT_ENCODINGS, settings, resize_stats)
+                    await asyncio.to_thread(handler._keep_outputs, shared, encoded, resize_stats)
+            except Exception as e:
+                await asyncio.to_thread(handler._generation_failed, shared, e)
+                return
+
+            await asyncio.to_thread(handler._deliver, shared)
+            self.logger.info(f"Timings for file {shared.index} of {shared.total}:\n{shared.timings.report()}")
+
+    async def _generate_image(self, handler: EventHandler, shared: SharedFile, prompt):
+        """
+            Async counterpart of EventHandler._generate_image, awaiting OpenAI instead of holding a thread.
+        """
+        # Wait for the model file that was selected while the design downloaded
+        await asyncio.wrap_future(shared.model_future)
+
+        with shared.timings.stage("generate", after=("normalize", "model", "prompt")):
+            # Hashing and the index search are CPU and SQLite work, keep them off the loop
+            key, generated_image = await asyncio.to_thread(handler._find_generation, shared, prompt)
+
+            if generated_image is None:
+                generated_image = await edit_image_async(prompt, shared.input_image, shared.model_image,
+                                                         handler.deadline, handler._partial_handler(shared))
+                await asyncio.to_thread(handler._store_generation, shared, prompt, key, generated_image)
+
+        return generated_image
@@ -0,0 +1,86 @@
+"""
+    Measures how quickly /slack/events acknowledges app_mention events under concurrent POSTs.
+    Runs the Flask app on a local port with the job workers disabled, so only the ingest path is timed.
+
+    Usage: python bench_ack_latency.py [requests] [concurrency]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+P99_BUDGET_MS = 100
+BENCH_CHANNEL = "CBENCHMARK"
+
+def post_event(port, i):
+    body = json.dumps({
+        "type": "event_callback",
+        "event_id": f"Ev{i:08d}",
+        "event": {
+            "type": "app_mention",
+            "user": "UBENCHMARK",
+            "text": "<@UBOT> --verbose",
+            "channel": BENCH_CHANNEL,
+            "files": [{"id": f"F{i:08d}", "filetype": "png", "url_private": "https://files.slack.com/x.png"}]
+        }
+    })
+
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    start = time.perf_counter()
+    conn.request("POST", "/slack/events", body=body, headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    response.read()
+    elapsed = (time.perf_counter() - start) * 1000
+    conn.close()
+
+    assert response.status == 200, response.status
+    return elapsed
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    # Run in a scratch directory with workers disabled so nothing but the ack path is exercised
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    os.chdir(tempfile.mkdtemp(prefix="bench_ack_"))
+    os.environ["VALID_CHANNEL_1"] = BENCH_CHANNEL
+    os.environ["JOB_DB_PATH"] = os.path.join(os.getcwd(), "jobs.db")
+    os.environ["JOB_WORKERS"] = "0"
+    os.environ["JOB_QUEUE_MAX_DEPTH"] = str(total + 1)
+
+    from werkzeug.serving import make_server
+    from app import app, start_services
+    start_services()
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    # Warm up the connection handling and the SQLite file
+    for i in range(10):
+        post_event(port, -i - 1)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(lambda i: post_event(port, i), range(total)))
+
+    server.shutdown()
+
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    print(f"{total} requests, concurrency {concurrency}")
+    print(f"p50: {p50:.1f}ms  p99: {p99:.1f}ms  max: {max(latencies):.1f}ms")
+
+    assert p99 < P99_BUDGET_MS, f"p99 ack latency {p99:.1f}ms is over the {P99_BUDGET_MS}ms budget"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+    Throughput of the resize + PNG encode stage as the image pool grows, on a synthetic
+    1024x1536 generation result. Each pool size renders the same batch of images.
+
+    Usage: python bench_image_pool.py [images]
+"""
+import os
+import sys
+import time
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from image_pool import _share, _render, _collect
+from vars import ENCODER_PROFILES
+
+def sample_image():
+    # Noise over a gradient compresses about as badly as a real generation
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 1024, dtype=np.uint8)[None, :, None]
+    pixels = (gradient + rng.integers(0, 32, (1536, 1024, 4), dtype=np.uint8)).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels, "RGBA").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def main():
+    images = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    image_bytes = sample_image()
+    cores = os.cpu_count() or 1
+
+    profile = ENCODER_PROFILES["png"]
+    sizes = sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+    baseline = None
+
+    shm = _share(image_bytes)
+    render = lambda count: pool.map(_render, [shm.name] * count, [len(image_bytes)] * count, [{}] * count, [profile] * count)
+
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # Start every process before timing
+            list(map(_collect, render(size)))
+
+            start = time.perf_counter()
+            for result in render(images):
+                _collect(result)
+            elapsed = time.perf_counter() - start
+
+        throughput = images / elapsed
+        baseline = baseline or throughput
+        print(f"{size} processes: {throughput:.2f} images/s ({throughput / baseline:.1f}x)")
+
+    shm.close()
+    shm.unlink()
+
+if __name__ == "__main__":
+    main()
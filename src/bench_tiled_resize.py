@@ -0,0 +1,51 @@
+"""
+    Time and estimated peak memory of the full frame resize against resize_image_tiled, on the synthetic
+    generation result of bench_image_pool, and a check that both paths give the same image.
+    They agree up to rounding: at most one level apart in alpha and two in premultiplied color,
+    one from the resize and one from premultiplying the stored 8 bit color again here.
+    The stored color of nearly transparent pixels can differ a lot more, which is why color is compared premultiplied.
+
+    Usage: python bench_tiled_resize.py [width height]
+"""
+import sys
+import time
+import numpy as np
+from io import BytesIO
+from PIL import Image
+from bench_image_pool import sample_image
+from reformat_image import resize_image, resize_image_tiled, OUTPUT_SIZE
+
+ALPHA_TOLERANCE = 1
+COLOR_TOLERANCE = 2
+
+def premultiplied(pixels):
+    return np.round(pixels[..., :3] * (pixels[..., 3:] / 255))
+
+def main():
+    new_size = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else OUTPUT_SIZE
+    image_bytes = sample_image()
+
+    full_stats = {}
+    start = time.perf_counter()
+    full = BytesIO()
+    resize_image(image_bytes, new_size, stats=full_stats).save(full, format="PNG", compress_level=6)
+    full_seconds = time.perf_counter() - start
+
+    tiled_stats = {}
+    start = time.perf_counter()
+    tiled = BytesIO()
+    resize_image_tiled(image_bytes, tiled, new_size, stats=tiled_stats)
+    tiled_seconds = time.perf_counter() - start
+
+    print(f"full frame: {full_seconds:.2f}s, peak {full_stats['peak_bytes'] / 2**20:.0f} MB")
+    print(f"tiled:      {tiled_seconds:.2f}s, peak {tiled_stats['peak_bytes'] / 2**20:.0f} MB")
+
+    full = np.asarray(Image.open(full), dtype=np.float64)
+    tiled = np.asarray(Image.open(tiled), dtype=np.float64)
+    alpha = np.abs(full[..., 3] - tiled[..., 3]).max()
+    color = np.abs(premultiplied(full) - premultiplied(tiled)).max()
+    print(f"largest difference: {alpha:.0f} in alpha, {color:.0f} in premultiplied color")
+    assert alpha <= ALPHA_TOLERANCE and color <= COLOR_TOLERANCE, "the tiled resize no longer matches the full frame one"
+
+if __name__ == "__main__":
+    main()
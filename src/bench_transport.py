@@ -0,0 +1,62 @@
+"""
+    Compares a fresh connection per call (module level requests.post) with the pooled session
+    from http_transport against a local keep-alive stub server.
+    A job makes about CALLS_PER_JOB Dropbox/Slack calls, so the report is per job.
+    The stub speaks plain HTTP, so the saving shown is the TCP setup only; against the real
+    HTTPS endpoints every reused connection also skips a TLS handshake.
+
+    Usage: python bench_transport.py [jobs]
+"""
+import sys
+import time
+import threading
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http_transport import session
+
+CALLS_PER_JOB = 6
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep connections open like the real APIs do
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def run_jobs(post, url, jobs):
+    start = time.perf_counter()
+    for _ in range(jobs):
+        for _ in range(CALLS_PER_JOB):
+            post(url, data=b'{"path": "/female/red/1.png"}').raise_for_status()
+    return (time.perf_counter() - start) / jobs * 1000
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/2/files/get_metadata"
+
+    # Warm up both paths once
+    run_jobs(requests.post, url, 5)
+    run_jobs(session.post, url, 5)
+
+    fresh = run_jobs(requests.post, url, jobs)
+    pooled = run_jobs(session.post, url, jobs)
+    server.shutdown()
+
+    print(f"{jobs} jobs x {CALLS_PER_JOB} calls")
+    print(f"new connection per call: {fresh:.2f}ms per job")
+    print(f"pooled session:          {pooled:.2f}ms per job")
+    print(f"saved:                   {fresh - pooled:.2f}ms per job ({(1 - pooled / fresh) * 100:.0f}%)")
+
+if __name__ == "__main__":
+    main()
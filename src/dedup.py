@@ -0,0 +1,77 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+__all__ = ["event_key", "make_dedup_store"]
+
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory") # memory or sqlite
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "dedup.db")
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 60 * 60))
+
+def event_key(event_id: str, files: list):
+    """
+        Builds the dedup key for a Slack event from its event_id and the ids of the attached files.
+    """
+    file_ids = sorted(f.get("id", "") for f in (files or []) if f)
+    return f"{event_id}|{','.join(file_ids)}"
+
+class MemoryDedupStore:
+    """
+        Remembers keys for ttl seconds in the memory of this process.
+    """
+    def __init__(self, ttl=DEDUP_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expiry = OrderedDict() # Insertion ordered so the oldest keys are evicted first
+
+    def claim(self, key: str):
+        """
+            Records the key. Returns True the first time a key is seen within the ttl, False after that.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if key in self._expiry:
+                return False
+            self._expiry[key] = now + self.ttl
+            return True
+
+    def _evict(self, now):
+        # Every key gets the same ttl so expired keys are always at the front
+        while self._expiry and next(iter(self._expiry.values())) <= now:
+            self._expiry.popitem(last=False)
+
+class SQLiteDedupStore:
+    """
+        Remembers keys for ttl seconds in a SQLite file so several processes can share them.
+    """
+    def __init__(self, db_path=DEDUP_DB_PATH, ttl=DEDUP_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5)
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS seen_expiry ON seen (expires_at)")
+
+    def claim(self, key: str):
+        """
+            Records the key. Returns True the first time a key is seen within the ttl, False after that.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM seen WHERE expires_at <= ?", (now,))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO seen (key, expires_at) VALUES (?, ?)",
+                (key, now + self.ttl)
+            )
+            return cursor.rowcount == 1
+
+def make_dedup_store(backend=DEDUP_BACKEND):
+    if backend == "sqlite":
+        return SQLiteDedupStore()
+    return MemoryDedupStore()
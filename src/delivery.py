@@ -0,0 +1,62 @@
+import time
+from concurrent.futures import as_completed
+from metrics import metrics
+
+__all__ = ["deliver"]
+
+class DeliveryReport:
+    """
+        Outcome of sending one output to every destination.
+        results maps each destination to {"ok", "seconds", "response"} or {"ok", "seconds", "error"}.
+    """
+    def __init__(self):
+        self.results = {}
+
+    @property
+    def ok(self):
+        return all(r["ok"] for r in self.results.values())
+
+    @property
+    def failed(self):
+        return [name for name, r in self.results.items() if not r["ok"]]
+
+    def __str__(self):
+        return ", ".join(
+            f"{name}: {'ok' if r['ok'] else 'failed'} in {r['seconds']:.2f}s"
+            for name, r in self.results.items()
+        )
+
+def _send(name, send):
+    start = time.perf_counter()
+    try:
+        response = send()
+        # The helpers report failures as a dict with an "error" key rather than raising
+        if isinstance(response, dict) and response.get("error"):
+            result = {"ok": False, "error": response}
+        else:
+            result = {"ok": True, "response": response}
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+
+    result["seconds"] = time.perf_counter() - start
+    metrics.incr(f"delivery.{name}.{'sent' if result['ok'] else 'failures'}")
+    return result
+
+def deliver(destinations: dict, executor, on_result=None):
+    """
+        Sends the output to every destination at the same time and returns a DeliveryReport.
+        destinations maps a name to a callable that does the upload. A destination that fails or
+        hangs doesn't hold up the others; on_result(name, result) is called as each one finishes.
+    """
+    futures = {executor.submit(_send, name, send): name for name, send in destinations.items()}
+
+    results = {}
+    for future in as_completed(futures):
+        name = futures[future]
+        results[name] = future.result()
+        if on_result:
+            on_result(name, results[name])
+
+    report = DeliveryReport()
+    report.results = {name: results[name] for name in destinations}
+    return report
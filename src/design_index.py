@@ -0,0 +1,221 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from io import BytesIO
+from PIL import Image
+from metrics import metrics
+from generation_cache import GENERATION_CACHE_TTL_SECONDS
+
+__all__ = ["design_index", "perceptual_hashes"]
+
+DESIGN_INDEX_ENABLED = os.getenv("DESIGN_INDEX", "true").lower() in ("1", "true", "yes")
+DESIGN_INDEX_DB_PATH = os.getenv("DESIGN_INDEX_DB_PATH", "designs.db")
+# Designs are only matched against results that can still be in the generation cache
+DESIGN_INDEX_TTL_SECONDS = int(os.getenv("DESIGN_INDEX_TTL_SECONDS", GENERATION_CACHE_TTL_SECONDS))
+# Largest Hamming distances, out of 64 bits, at which two designs count as the same
+DESIGN_PHASH_DISTANCE = int(os.getenv("DESIGN_PHASH_DISTANCE", 6))
+DESIGN_DHASH_DISTANCE = int(os.getenv("DESIGN_DHASH_DISTANCE", 10))
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+# Rows the arrays of the index start with, they double whenever they fill up
+INDEX_INITIAL_CAPACITY = 1024
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+DCT_MATRIX = _dct_matrix(DCT_SIZE)
+
+def _pack(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big", signed=True)
+
+def perceptual_hashes(image):
+    """
+        Returns the (pHash, dHash) of an image given as bytes or a path, as signed 64 bit ints.
+        Transparent areas are flattened onto white first, as designs are mostly drawn on a transparent background.
+    """
+    image = Image.open(BytesIO(image) if isinstance(image, (bytes, bytearray)) else image)
+    image.draft("RGB", (DCT_SIZE * 2, DCT_SIZE * 2)) # JPEGs decode at a fraction of their size
+
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        small = image.convert("RGBA").resize((DCT_SIZE * 2, DCT_SIZE * 2), Image.Resampling.BOX)
+        background = Image.new("RGBA", small.size, (255, 255, 255, 255))
+        gray = Image.alpha_composite(background, small).convert("L")
+    else:
+        gray = image.convert("L").resize((DCT_SIZE * 2, DCT_SIZE * 2), Image.Resampling.BOX)
+
+    # pHash: signs of the lowest frequencies of the DCT against their median, leaving out the DC term
+    pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.Resampling.BOX), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    phash = _pack(low > np.median(low.ravel()[1:]))
+
+    # dHash: whether each pixel is brighter than its right hand neighbour
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX), dtype=np.int16)
+    dhash = _pack(pixels[:, 1:] > pixels[:, :-1])
+
+    return phash, dhash
+
+class DesignIndex:
+    """
+        Perceptual hashes of every design the bot has generated from, with the generation cache key of the result.
+        Re-exported, recompressed or slightly cropped copies of a design land within a few bits of it,
+        so a new submission close enough to a recent one can reuse that result.
+
+        Rows live in a SQLite file shared by every process and are mirrored in NumPy arrays,
+        so a search is one vectorized XOR and popcount over the whole index.
+        The arrays grow by doubling, rows are dropped from their front as they expire, and
+        variants are held as the first 128 bits of their digest in two int64s.
+    """
+    def __init__(self, db_path=DESIGN_INDEX_DB_PATH, ttl=DESIGN_INDEX_TTL_SECONDS,
+                 phash_distance=DESIGN_PHASH_DISTANCE, dhash_distance=DESIGN_DHASH_DISTANCE):
+        self.ttl = ttl
+        self.phash_distance = phash_distance
+        self.dhash_distance = dhash_distance
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._last_id = 0
+
+        # Live rows are [_start, _size), the ones before _start expired and are dropped on the next growth
+        self._start = 0
+        self._size = 0
+        self._phash = np.empty(INDEX_INITIAL_CAPACITY, dtype=np.int64)
+        self._dhash = np.empty(INDEX_INITIAL_CAPACITY, dtype=np.int64)
+        self._created = np.empty(INDEX_INITIAL_CAPACITY, dtype=np.float64)
+        self._variants = np.empty((INDEX_INITIAL_CAPACITY, 2), dtype=np.int64)
+        self._keys = []
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS designs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phash INTEGER NOT NULL,
+                    dhash INTEGER NOT NULL,
+                    variant TEXT NOT NULL,
+                    result_key TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS designs_created ON designs (created_at)")
+            self._conn.execute("DELETE FROM designs WHERE created_at <= ?", (time.time() - self.ttl,))
+            self._refresh()
+
+    @staticmethod
+    def variant(*parts):
+        """
+            Digest of everything besides the design that shapes a result, like the prompt and the asked for model.
+            Only designs generated with the same variant are matched.
+        """
+        return hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _variant_ints(variants):
+        return np.frombuffer(b"".join(bytes.fromhex(v)[:16] for v in variants), dtype=np.int64).reshape(-1, 2)
+
+    def _refresh(self):
+        """
+            Loads the rows other processes added since the last call and drops the expired ones.
+        """
+        rows = self._conn.execute(
+            "SELECT id, phash, dhash, variant, result_key, created_at FROM designs WHERE id > ? ORDER BY id",
+            (self._last_id,)
+        ).fetchall()
+        if rows:
+            ids, phashes, dhashes, variants, keys, created = zip(*rows)
+            self._last_id = ids[-1]
+            self._reserve(len(rows))
+
+            end = self._size + len(rows)
+            self._phash[self._size:end] = phashes
+            self._dhash[self._size:end] = dhashes
+            self._created[self._size:end] = created
+            self._variants[self._size:end] = self._variant_ints(variants)
+            self._keys += keys
+            self._size = end
+
+        self._prune()
+        metrics.set_gauge("design_index.size", self._size - self._start)
+
+    def _reserve(self, count):
+        """
+            Makes room for count more rows, moving the live rows to the front of arrays twice their number.
+        """
+        if self._size + count <= len(self._phash):
+            return
+
+        live = slice(self._start, self._size)
+        capacity = max(INDEX_INITIAL_CAPACITY, 2 * (self._size - self._start + count))
+        for name in ("_phash", "_dhash", "_created", "_variants"):
+            old = getattr(self, name)
+            grown = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            grown[:self._size - self._start] = old[live]
+            setattr(self, name, grown)
+
+        self._keys = self._keys[live]
+        self._size -= self._start
+        self._start = 0
+
+    def _prune(self):
+        """
+            Drops the rows that expired from the front of the arrays. Rows are in insertion order,
+            so the few a clock difference between processes leaves further in are skipped by find instead.
+        """
+        alive = self._created[self._start:self._size] > time.time() - self.ttl
+        expired = int(alive.argmax()) if alive.any() else len(alive)
+        if expired:
+            self._keys[self._start:self._start + expired] = [None] * expired
+            self._start += expired
+            metrics.incr("design_index.expired", expired)
+
+    def add(self, hashes: tuple, variant: str, result_key: str):
+        phash, dhash = hashes
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO designs (phash, dhash, variant, result_key, created_at) VALUES (?, ?, ?, ?, ?)",
+                (phash, dhash, variant, result_key, now)
+            )
+            self._conn.execute("DELETE FROM designs WHERE created_at <= ?", (now - self.ttl,))
+            self._refresh()
+
+    def find(self, hashes: tuple, variant: str):
+        """
+            Returns the closest recent design with the same variant within the distance thresholds,
+            as {"result_key", "phash_distance", "dhash_distance"}, or None.
+        """
+        phash, dhash = hashes
+        with self._lock:
+            self._refresh()
+            if self._size == self._start:
+                return None
+
+            live = slice(self._start, self._size)
+            phash_distance = np.bitwise_count((self._phash[live] ^ np.int64(phash)).view(np.uint64))
+            dhash_distance = np.bitwise_count((self._dhash[live] ^ np.int64(dhash)).view(np.uint64))
+            matches = (
+                (phash_distance <= self.phash_distance)
+                & (dhash_distance <= self.dhash_distance)
+                & (self._variants[live] == self._variant_ints([variant])).all(axis=1)
+                & (self._created[live] > time.time() - self.ttl)
+            )
+            if not matches.any():
+                return None
+
+            distance = np.where(matches, phash_distance.astype(np.int32) + dhash_distance, np.iinfo(np.int32).max)
+            best = int(distance.argmin())
+            metrics.incr("design_index.matches")
+            return {
+                "result_key": self._keys[self._start + best],
+                "phash_distance": int(phash_distance[best]),
+                "dhash_distance": int(dhash_distance[best])
+            }
+
+design_index = DesignIndex() if DESIGN_INDEX_ENABLED else None
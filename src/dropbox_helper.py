@@ -1,10 +1,14 @@
 import os
+import time
 import pathlib
-import pathlib
+import threading
 import requests
 import json
 import base64
+import hashlib
 from dotenv import load_dotenv
+from metrics import metrics
+from http_transport import session
 
 # Load environment variables
 load_dotenv()
@@ -17,6 +21,10 @@ MODELS_FOLDER_ID = os.getenv("MODELS_FOLDER_ID")
 # Endpoint to get the access token
 DROPBOX_TOKEN_URL = "https://api.dropboxapi.com/oauth2/token"
 
+# Uploads bigger than this go through an upload session one chunk at a time
+UPLOAD_CHUNK_BYTES = int(os.getenv("DROPBOX_UPLOAD_CHUNK_BYTES", 8 * 1024 * 1024))
+UPLOAD_CHUNK_RETRIES = 3
+
 def get_access_token(app_key, app_secret, refresh_token):
     """
     Uses the refresh token to get a new short-lived access token.
@@ -33,18 +41,89 @@ def get_access_token(app_key, app_secret, refresh_token):
         "refresh_token": refresh_token
     }
 
-    response = requests.post(DROPBOX_TOKEN_URL, headers=headers, data=data)
+    response = session.post(DROPBOX_TOKEN_URL, headers=headers, data=data)
     response.raise_for_status()
 
     return response.json()["access_token"]
 
+class TokenManager:
+    """
+    Caches the short-lived Dropbox access token and refreshes it shortly before it expires.
+    Only one thread refreshes at a time, the others wait for it and use the new token.
+    """
+    def __init__(self, app_key, app_secret, refresh_token, refresh_margin=300):
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.refresh_token = refresh_token
+        self.refresh_margin = refresh_margin # Seconds before expiry at which the token is refreshed
+
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+
+    def get(self):
+        """
+        Returns a valid access token, fetching a new one if the cached token is missing or about to expire.
+        """
+        if self._access_token and time.monotonic() < self._expires_at:
+            return self._access_token
+
+        with self._lock:
+            # Another thread may have refreshed while this one waited for the lock
+            if self._access_token and time.monotonic() < self._expires_at:
+                return self._access_token
+
+            token, expires_in = self._refresh()
+            self._access_token = token
+            self._expires_at = time.monotonic() + max(expires_in - self.refresh_margin, 0)
+            metrics.incr("dropbox.token_refreshes")
+            return token
+
+    def invalidate(self):
+        """
+        Forgets the cached token, e.g. after Dropbox rejected it.
+        """
+        with self._lock:
+            self._access_token = None
+            self._expires_at = 0
+
+    def _refresh(self):
+        basic_auth = base64.b64encode(f"{self.app_key}:{self.app_secret}".encode()).decode()
+
+        headers = {
+            "Authorization": f"Basic {basic_auth}",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token
+        }
+
+        response = session.post(DROPBOX_TOKEN_URL, headers=headers, data=data)
+        response.raise_for_status()
+        result = response.json()
+
+        return result["access_token"], result.get("expires_in", 14400)
+
+# Shared by every Dropbox call in the process
+token_manager = TokenManager(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+
+def _check_auth_error(e):
+    """
+    Drops the cached token when Dropbox answers 401 so the next call fetches a fresh one.
+    """
+    response = getattr(e, "response", None)
+    if response is not None and response.status_code == 401:
+        token_manager.invalidate()
+
 def list_subfolders(folder_path: str, folder_id: str):
     """
     Lists the subfolders inside a Dropbox folder given its path and namespace id.
     """
     # Exchange refresh token for short-lived access token
     try:
-        access_token = get_access_token(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+        access_token = token_manager.get()
     except Exception as e:
         return {"error": "Failed to get access token", "details": str(e)}
     
@@ -68,7 +147,7 @@ def list_subfolders(folder_path: str, folder_id: str):
     }
 
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = session.post(url, headers=headers, data=json.dumps(data))
         response.raise_for_status()
 
         entries = response.json().get('entries', [])
@@ -76,6 +155,7 @@ def list_subfolders(folder_path: str, folder_id: str):
         return subfolders
 
     except requests.RequestException as e:
+        _check_auth_error(e)
         return {"error": str(e)}
     
 def count_files_in_subfolder(folder_id: str, subfolder_path: str):
@@ -89,7 +169,7 @@ def count_files_in_subfolder(folder_id: str, subfolder_path: str):
     """
     # Exchange refresh token for short-lived access token
     try:
-        access_token = get_access_token(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+        access_token = token_manager.get()
     except Exception as e:
         return {"error": "Failed to get access token", "details": str(e)}
     
@@ -117,7 +197,7 @@ def count_files_in_subfolder(folder_id: str, subfolder_path: str):
 
     try:
         while has_more:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
+            response = session.post(url, headers=headers, data=json.dumps(data))
             response.raise_for_status()
             result = response.json()
 
@@ -135,9 +215,10 @@ def count_files_in_subfolder(folder_id: str, subfolder_path: str):
         return {"file_count": file_count}
 
     except requests.RequestException as e:
+        _check_auth_error(e)
         return {"error": str(e)}
 
-def download_file_from_shared_folder(folder_id: str, file_path: str, download_to: str):
+def download_file_from_shared_folder(folder_id: str, file_path: str, download_to: str = None):
     """
     Downloads a file (e.g., image) from a shared Dropbox folder using namespace ID.
     
@@ -145,10 +226,10 @@ def download_file_from_shared_folder(folder_id: str, file_path: str, download_to
     :param file_path: Path to file inside shared folder (e.g. "/image.jpg")
     :param access_token: OAuth access token
     :param user_id: Dropbox user ID
-    :param download_to: Local path to save downloaded file
+    :param download_to: Local path to save downloaded file, if None the bytes are returned under "content"
     """
     try:
-        access_token = get_access_token(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+        access_token = token_manager.get()
     except Exception as e:
         return {"error": "Failed to get access token", "details": str(e)}
     
@@ -167,43 +248,66 @@ def download_file_from_shared_folder(folder_id: str, file_path: str, download_to
     }
 
     try:
-        response = requests.post(url, headers=headers, stream=True)
+        if download_to is None:
+            response = session.post(url, headers=headers)
+            response.raise_for_status()
+            return {"message": "File downloaded successfully", "content": response.content}
+
+        response = session.post(url, headers=headers, stream=True)
         response.raise_for_status()
 
         with open(download_to, 'wb') as f:
             for chunk in response.iter_content(chunk_size=4096):
                 if chunk:
                     f.write(chunk)
+        metrics.incr("pipeline.disk_writes")
         
         return {"message": f"File downloaded successfully to {download_to}"}
     
     except requests.RequestException as e:
+        _check_auth_error(e)
         return {"error": "Failed to download file", "details": str(e)}
 
-def upload_to_shared_folder(file_path: str, folder_id):
+def upload_to_shared_folder(file_path: str, folder_id, content: bytes = None):
     """
         Uploads a given file path to a shared dropbox folder. 
         The function must be supplied a known file ID and user id to perform this request. 
+        Pass content to upload bytes already in memory under the name of file_path, without reading the disk.
     """
     # Convert file path to a Path object
     file = pathlib.Path(file_path)
     
-    if not file.exists():
+    if content is None and not file.exists():
         return {"error": "File does not exist"}
     
     # Exchange refresh token for short-lived access token
     try:
-        access_token = get_access_token(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+        access_token = token_manager.get()
     except Exception as e:
         return {"error": "Failed to get access token", "details": str(e)}
     
-    # Read the file content
-    file_content = file.read_bytes()
     file_name = file.name
 
     # Specify the Dropbox path using the shared folder ID
     dropbox_path = f"/{file_name}"  # The file will appear in the root of the shared folder
 
+    # Large outputs are streamed in chunks through an upload session instead of one big request
+    size = len(content) if content is not None else file.stat().st_size
+    if size > UPLOAD_CHUNK_BYTES:
+        try:
+            cursor = _upload_in_session(folder_id, _iter_chunks(file, content), close=False)
+            metadata = _upload_session_finish(folder_id, cursor, dropbox_path)
+            return {"message": "File uploaded successfully", "dropbox_path": metadata.get("path_display", dropbox_path)}
+        except requests.RequestException as e:
+            _check_auth_error(e)
+            print(f"Error Details: {str(e)}")
+            return {"error": "Failed to upload file to Dropbox", "details": str(e)}
+
+    # Read the file content
+    if content is None:
+        content = file.read_bytes()
+        metrics.incr("pipeline.disk_reads")
+
     url = "https://content.dropboxapi.com/2/files/upload"
 
     # Set the request headers
@@ -229,16 +333,345 @@ def upload_to_shared_folder(file_path: str, folder_id):
     # print(f"Dropbox Path: {dropbox_path}")
 
     try:
-        response = requests.post(url, headers=headers, data=file_content)
+        response = session.post(url, headers=headers, data=content)
         print(f"Response Status: {response.status_code}")
         # print(f"Response Text: {response.text}")
         response.raise_for_status()  # This will raise an error for non-200 responses
-        return {"message": "File uploaded successfully", "dropbox_path": dropbox_path}
+        # autorename may have stored the file under another name
+        return {"message": "File uploaded successfully", "dropbox_path": response.json().get("path_display", dropbox_path)}
 
     except requests.RequestException as e:
+        _check_auth_error(e)
         print(f"Error Details: {str(e)}")
         return {"error": "Failed to upload file to Dropbox", "details": str(e)}
 
+def _commit_info(dropbox_path: str):
+    return {
+        "path": dropbox_path,
+        "mode": "add",
+        "autorename": True,
+        "mute": False
+    }
+
+def _iter_chunks(file: pathlib.Path, content: bytes = None):
+    """
+    Yields the upload in chunks of UPLOAD_CHUNK_BYTES, from memory or straight from disk,
+    so no more than one chunk is copied at a time.
+    """
+    if content is not None:
+        view = memoryview(content)
+        for i in range(0, len(view), UPLOAD_CHUNK_BYTES):
+            chunk = bytes(view[i:i + UPLOAD_CHUNK_BYTES])
+            metrics.count_copy(len(chunk))
+            yield chunk
+        return
+
+    with open(file, "rb") as f:
+        metrics.incr("pipeline.disk_reads")
+        while chunk := f.read(UPLOAD_CHUNK_BYTES):
+            yield chunk
+
+def _upload_session_call(endpoint: str, folder_id: str, arg: dict, chunk: bytes = b""):
+    """
+    Posts a chunk to one of the content endpoints of the upload session API.
+    """
+    headers = _namespace_headers(token_manager.get(), folder_id)
+    headers["Content-Type"] = "application/octet-stream"
+    headers["Dropbox-API-Arg"] = json.dumps(arg)
+
+    return session.post(f"https://content.dropboxapi.com/2/files/{endpoint}", headers=headers, data=chunk)
+
+def _append_chunk(folder_id: str, session_id: str, offset: int, chunk: bytes, close: bool):
+    """
+    Appends a chunk to an upload session and returns the new offset.
+    A failed append is retried from the offset Dropbox reports it has, so a chunk that was
+    partly received is resumed rather than sent again from the start.
+    """
+    sent = 0 # Bytes of this chunk Dropbox already has
+
+    for attempt in range(UPLOAD_CHUNK_RETRIES):
+        try:
+            response = _upload_session_call("upload_session/append_v2", folder_id, {
+                "cursor": {"session_id": session_id, "offset": offset + sent},
+                "close": close
+            }, chunk[sent:])
+
+            if response.status_code == 409:
+                error = response.json().get("error", {})
+                if error.get(".tag") == "incorrect_offset":
+                    sent = error["correct_offset"] - offset
+                    print(f"Resuming chunk at offset {error['correct_offset']}")
+                    continue
+
+            response.raise_for_status()
+            return offset + len(chunk)
+
+        except requests.RequestException as e:
+            _check_auth_error(e)
+            if attempt == UPLOAD_CHUNK_RETRIES - 1:
+                raise
+            print(f"Chunk upload failed, retrying: {e}")
+            time.sleep(2 ** attempt)
+
+    raise requests.RequestException(f"Chunk at offset {offset} could not be uploaded")
+
+def _upload_in_session(folder_id: str, chunks, close: bool):
+    """
+    Uploads the chunks into a new upload session and returns its cursor.
+    The session is closed with the last chunk when close is set, as finish_batch requires.
+    """
+    chunks = iter(chunks)
+    pending = next(chunks, b"")
+    following = next(chunks, None)
+
+    response = _upload_session_call("upload_session/start", folder_id, {
+        "close": close and following is None
+    }, pending)
+    response.raise_for_status()
+    session_id = response.json()["session_id"]
+    offset = len(pending)
+
+    while following is not None:
+        pending, following = following, next(chunks, None)
+        offset = _append_chunk(folder_id, session_id, offset, pending, close and following is None)
+
+    return {"session_id": session_id, "offset": offset}
+
+def _upload_session_finish(folder_id: str, cursor: dict, dropbox_path: str):
+    response = _upload_session_call("upload_session/finish", folder_id, {
+        "cursor": cursor,
+        "commit": _commit_info(dropbox_path)
+    })
+    response.raise_for_status()
+    return response.json()
+
+class UploadBatch:
+    """
+    Uploads several files to a shared folder as closed upload sessions and commits all of them
+    with a single upload_session/finish_batch_v2 call.
+    """
+    def __init__(self, folder_id: str):
+        self.folder_id = folder_id
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def add(self, file_path: str, content: bytes = None):
+        """
+        Uploads the file under the name of file_path. Nothing appears in Dropbox until commit.
+        """
+        file = pathlib.Path(file_path)
+        dropbox_path = f"/{file.name}"
+
+        try:
+            cursor = _upload_in_session(self.folder_id, _iter_chunks(file, content), close=True)
+        except requests.RequestException as e:
+            _check_auth_error(e)
+            return {"error": "Failed to upload file to Dropbox", "details": str(e)}
+
+        with self._lock:
+            self.entries.append({"cursor": cursor, "commit": _commit_info(dropbox_path)})
+        return {"message": "File uploaded, waiting for commit", "dropbox_path": dropbox_path}
+
+    def commit(self):
+        """
+        Commits every uploaded file at once. Returns the per-file results under "entries",
+        in the order the files were added, each with the requested_path it was added under.
+        """
+        with self._lock:
+            entries, self.entries = self.entries, []
+
+        if not entries:
+            return {"entries": []}
+
+        try:
+            headers = _namespace_headers(token_manager.get(), self.folder_id)
+            response = session.post(
+                "https://api.dropboxapi.com/2/files/upload_session/finish_batch_v2",
+                headers=headers,
+                data=json.dumps({"entries": entries})
+            )
+            response.raise_for_status()
+            result = response.json()
+
+            for entry, added in zip(result.get("entries", []), entries):
+                entry["requested_path"] = added["commit"]["path"]
+            return result
+
+        except requests.RequestException as e:
+            _check_auth_error(e)
+            return {"error": "Failed to commit files to Dropbox", "details": str(e)}
+
+def _namespace_headers(access_token: str, folder_id: str):
+    """
+    Headers for a Dropbox API call made as USER_ID inside the shared folder namespace folder_id.
+    """
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Dropbox-API-Select-User": USER_ID,
+        "Dropbox-API-Path-Root": json.dumps({
+            ".tag": "namespace_id",
+            "namespace_id": folder_id
+        }),
+        "Content-Type": "application/json"
+    }
+
+def list_files_in_folder(folder_id: str, folder_path: str, recursive: bool = True):
+    """
+    Lists every file inside a folder of a Dropbox shared folder, following pagination.
+    Each entry carries path_lower, size, rev and content_hash.
+
+    :param folder_id: Dropbox namespace_id for shared folder
+    :param folder_path: Folder inside the shared folder, "" for its root
+    :param recursive: Whether to include the files of subfolders
+    """
+    try:
+        access_token = token_manager.get()
+    except Exception as e:
+        return {"error": "Failed to get access token", "details": str(e)}
+
+    url = "https://api.dropboxapi.com/2/files/list_folder"
+    headers = _namespace_headers(access_token, folder_id)
+
+    data = {
+        "path": folder_path,
+        "recursive": recursive,
+        "include_media_info": False,
+        "include_deleted": False
+    }
+
+    files = []
+    has_more = True
+
+    try:
+        while has_more:
+            response = session.post(url, headers=headers, data=json.dumps(data))
+            response.raise_for_status()
+            result = response.json()
+
+            files += [entry for entry in result.get('entries', []) if entry['.tag'] == 'file']
+
+            url = "https://api.dropboxapi.com/2/files/list_folder/continue"
+            data = {"cursor": result['cursor']}
+            has_more = result.get('has_more', False)
+
+        return {"entries": files, "cursor": result['cursor']}
+
+    except requests.RequestException as e:
+        _check_auth_error(e)
+        return {"error": str(e)}
+
+def list_folder_changes(folder_id: str, cursor: str):
+    """
+    Returns everything that changed in a folder since the cursor was issued, following pagination.
+    Entries are tagged "file", "folder" or "deleted".
+    """
+    try:
+        access_token = token_manager.get()
+    except Exception as e:
+        return {"error": "Failed to get access token", "details": str(e)}
+
+    url = "https://api.dropboxapi.com/2/files/list_folder/continue"
+    headers = _namespace_headers(access_token, folder_id)
+
+    changes = []
+    has_more = True
+
+    try:
+        while has_more:
+            response = session.post(url, headers=headers, data=json.dumps({"cursor": cursor}))
+            response.raise_for_status()
+            result = response.json()
+
+            changes += result.get('entries', [])
+            cursor = result['cursor']
+            has_more = result.get('has_more', False)
+
+        return {"entries": changes, "cursor": cursor}
+
+    except requests.RequestException as e:
+        _check_auth_error(e)
+        return {"error": str(e)}
+
+def longpoll_folder(cursor: str, timeout: int = 120):
+    """
+    Waits up to timeout seconds for a change in the folder the cursor belongs to.
+    Needs no access token. Returns {"changes": bool} and possibly a "backoff" in seconds.
+    """
+    url = "https://notify.dropboxapi.com/2/files/list_folder/longpoll"
+
+    try:
+        response = session.post(
+            url,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps({"cursor": cursor, "timeout": timeout}),
+            timeout=timeout + 90 # Dropbox may hold the request up to 90s past the timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    except requests.RequestException as e:
+        return {"error": str(e)}
+
+def get_file_metadata(folder_id: str, file_path: str):
+    """
+    Returns the metadata of a file in a Dropbox shared folder, including its rev and content_hash.
+    """
+    try:
+        access_token = token_manager.get()
+    except Exception as e:
+        return {"error": "Failed to get access token", "details": str(e)}
+
+    url = "https://api.dropboxapi.com/2/files/get_metadata"
+    headers = _namespace_headers(access_token, folder_id)
+
+    try:
+        response = session.post(url, headers=headers, data=json.dumps({"path": file_path}))
+        response.raise_for_status()
+        return response.json()
+
+    except requests.RequestException as e:
+        _check_auth_error(e)
+        return {"error": str(e)}
+
+def create_shared_link(folder_id: str, file_path: str):
+    """
+    Returns {"url": ...}, a shared link to a file in a Dropbox shared folder.
+    The existing link is returned if the file already has one.
+    """
+    try:
+        access_token = token_manager.get()
+    except Exception as e:
+        return {"error": "Failed to get access token", "details": str(e)}
+
+    url = "https://api.dropboxapi.com/2/sharing/create_shared_link_with_settings"
+    headers = _namespace_headers(access_token, folder_id)
+
+    try:
+        response = session.post(url, headers=headers, data=json.dumps({"path": file_path}))
+        if response.status_code == 409:
+            error = response.json().get("error", {})
+            if error.get(".tag") == "shared_link_already_exists" and "metadata" in error.get("shared_link_already_exists", {}):
+                return {"url": error["shared_link_already_exists"]["metadata"]["url"]}
+
+        response.raise_for_status()
+        return {"url": response.json()["url"]}
+
+    except requests.RequestException as e:
+        _check_auth_error(e)
+        return {"error": str(e)}
+
+def dropbox_content_hash(content: bytes):
+    """
+    Computes the Dropbox content_hash of some bytes: the SHA-256 of the SHA-256 of every 4 MB block.
+    """
+    block_size = 4 * 1024 * 1024
+    view = memoryview(content)
+    block_hashes = b"".join(
+        hashlib.sha256(view[i:i + block_size]).digest()
+        for i in range(0, len(view), block_size)
+    )
+    return hashlib.sha256(block_hashes).hexdigest()
+
 def main():
     file_count = count_files_in_subfolder(MODELS_FOLDER_ID, "/female/red")
     print(file_count)
@@ -1,65 +1,175 @@
 import random 
 import os
 import base64
+import inspect
 import pathlib
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from metrics import metrics
+from openai_limiter import openai_limiter
+from slack_helper import sniff_image_format
+from http_transport import openai_http_client, openai_async_http_client
 
 load_dotenv()
 
-__all__ = ["edit_image"]
+__all__ = ["edit_image", "edit_image_async"]
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are left to openai_limiter, which also backs off the other calls in flight
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=openai_http_client(), max_retries=0)
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=openai_async_http_client(), max_retries=0)
 model = "gpt-4.1"  # "dall-e-2 "
+# Partial frames streamed while the image generates (0 to 3), 0 waits for the whole response instead
+OPENAI_PARTIAL_IMAGES = int(os.getenv("OPENAI_PARTIAL_IMAGES", 2))
 
-def encode_image(file_path):
-    with open(file_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
-    return base64_image
+def encode_image(image):
+    """
+        Returns an image given either its bytes or a path to it on disk as a base64 data URL,
+        labelled with the MIME type of its actual format.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            image = f.read()
+        metrics.incr("pipeline.disk_reads")
 
-def edit_image(prompt, input_filename, model_filename):
+    image_format = sniff_image_format(image[:12]) or "png"
+    base64_image = base64.b64encode(image).decode("utf-8")
+    metrics.count_copy(len(base64_image), 2) # The base64 bytes, then the str decoded from them
+    return f"data:image/{image_format};base64,{base64_image}"
+
+def build_input(prompt, input_image, model_image):
+    """
+        Builds the Responses API input carrying the prompt, the design and the model image.
+        The images are expected to be normalized already (see reformat_image.normalize_image).
+    """
+    image_url1 = encode_image(input_image)
+    image_url2 = encode_image(model_image)
+
+    payload_bytes = len(prompt) + len(image_url1) + len(image_url2)
+    metrics.incr("openai.requests")
+    metrics.incr("openai.payload_bytes", payload_bytes)
+    metrics.set_gauge("openai.last_payload_bytes", payload_bytes)
+    print(f"OpenAI request payload: {payload_bytes / 1024:.0f} KB")
+
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": prompt},
+                {
+                    "type": "input_image",
+                    "image_url": image_url1,
+                },
+                {
+                    "type": "input_image",
+                    "image_url": image_url2,
+                },
+            ],
+        }
+    ]
+
+def extract_image(response):
+    """
+        Returns the bytes of the first generated image in a Responses API response.
+    """
+    image_generation_calls = [
+        output
+        for output in response.output
+        if output.type == "image_generation_call"
+    ]
+
+    image_data = [output.result for output in image_generation_calls]
+
+    return base64.b64decode(image_data[0])
+
+def image_tool():
+    tool = {"type": "image_generation"}
+    if OPENAI_PARTIAL_IMAGES:
+        tool["partial_images"] = OPENAI_PARTIAL_IMAGES
+    return tool
+
+def _final_image(event):
+    """
+        Returns the bytes of the generated image if the stream event carries it, else None.
+    """
+    if event.type == "response.output_item.done" and event.item.type == "image_generation_call" and event.item.result:
+        return base64.b64decode(event.item.result)
+    return None
+
+def _partial_image(event):
+    """
+        Returns (index, bytes) of a partial frame if the stream event carries one, else None.
+    """
+    if event.type == "response.image_generation_call.partial_image":
+        return event.partial_image_index, base64.b64decode(event.partial_image_b64)
+    return None
+
+def edit_image(prompt, input_image, model_image, deadline=None, on_partial=None):
+    """
+        Generates the advert from the design and the model image.
+        Both images can be given as bytes or as paths on disk.
+        The call waits its turn in openai_limiter and is retried while OpenAI is busy, until deadline
+        (a time.monotonic() value, OPENAI_JOB_DEADLINE_SECONDS from now by default).
+        With OPENAI_PARTIAL_IMAGES set the response is streamed and on_partial(index, image) is called
+        with every partial frame as it arrives; the final image is returned as soon as its event does.
+    """
     try:
-        if os.path.exists(input_filename):
+        if input_image:
             print(f"File is valid and can be used for image generation.")
         
         else:
             print(f"File is invalid and cannot be used for image generation.")
-        
-        base64_image1 = encode_image(input_filename)
-        base64_image2 = encode_image(model_filename)
 
-        response = client.responses.create(
-            model="gpt-4.1",
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": prompt},
-                        {
-                            "type": "input_image",
-                            "image_url": f"data:image/jpeg;base64,{base64_image1}",
-                        },
-                        {
-                            "type": "input_image",
-                            "image_url": f"data:image/jpeg;base64,{base64_image2}",
-                        },
-                    ],
-                }
-            ],
-            tools=[{"type": "image_generation"}],
-        )
+        request_input = build_input(prompt, input_image, model_image)
+        stream = bool(OPENAI_PARTIAL_IMAGES)
 
-        image_generation_calls = [
-            output
-            for output in response.output
-            if output.type == "image_generation_call"
-        ]
+        def consume(events):
+            with events:
+                for event in events:
+                    if (partial := _partial_image(event)) and on_partial:
+                        on_partial(*partial)
+                    elif (image := _final_image(event)) is not None:
+                        return image
+            raise ValueError("The response stream ended without an image")
+
+        return openai_limiter.call(lambda: client.responses.with_raw_response.create(
+            model=model,
+            input=request_input,
+            tools=[image_tool()],
+            stream=stream,
+        ), deadline, consume if stream else extract_image)
+    except Exception as e:
+        print(f"Error during image generation: {e}")
+        raise
+
+async def edit_image_async(prompt, input_image, model_image, deadline=None, on_partial=None):
+    """
+        Same as edit_image, but waits for OpenAI without holding a thread.
+        on_partial may be a plain function or a coroutine function.
+    """
+    try:
+        request_input = build_input(prompt, input_image, model_image)
+        stream = bool(OPENAI_PARTIAL_IMAGES)
 
-        image_data = [output.result for output in image_generation_calls]
+        async def consume(events):
+            async with events:
+                async for event in events:
+                    if (partial := _partial_image(event)) and on_partial:
+                        result = on_partial(*partial)
+                        if inspect.isawaitable(result):
+                            await result
+                    elif (image := _final_image(event)) is not None:
+                        return image
+            raise ValueError("The response stream ended without an image")
 
-        image_bytes = base64.b64decode(image_data[0])
+        async def parse(response):
+            return extract_image(response)
 
-        return image_bytes
+        return await openai_limiter.call_async(lambda: async_client.responses.with_raw_response.create(
+            model=model,
+            input=request_input,
+            tools=[image_tool()],
+            stream=stream,
+        ), deadline, consume if stream else parse)
     except Exception as e:
         print(f"Error during image generation: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,157 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import metrics
+
+__all__ = ["generation_cache"]
+
+GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", "generation_cache")
+GENERATION_CACHE_BYTES = int(os.getenv("GENERATION_CACHE_BYTES", 1024 * 1024 * 1024))
+GENERATION_CACHE_TTL_SECONDS = int(os.getenv("GENERATION_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+class GenerationCache:
+    """
+        On disk cache of image generation results, addressed by what went into the generation:
+        the design, the model image, the prompt and the OpenAI model.
+        A re-posted design with the same model and prompt gets the earlier result without a new generation.
+        Results expire after ttl seconds and the least recently used go once the cache is over max_bytes.
+    """
+    def __init__(self, cache_dir=GENERATION_CACHE_DIR, max_bytes=GENERATION_CACHE_BYTES, ttl=GENERATION_CACHE_TTL_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> size, least recently used first
+        self._bytes = 0
+
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_disk()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load_disk(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".png"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            files.append((stat.st_atime, name[:-4], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def key(self, input_image, model_image, prompt: str, model: str):
+        """
+            Returns the cache key of a generation. The images can be bytes or paths on disk.
+        """
+        digest = hashlib.sha256()
+        for part in (_sha256(input_image), _sha256(model_image), prompt, model):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str, count=True):
+        """
+            Returns the cached result for key, or None on a miss.
+            count=False leaves the lookup out of the hit rate, for reads that follow up on a counted miss.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            known = key in self._entries
+
+        content = None
+        if known:
+            path = self._path(key)
+            try:
+                if time.time() - os.stat(path).st_mtime > self.ttl:
+                    self._remove(key)
+                    metrics.incr("generation_cache.expired")
+                else:
+                    with open(path, "rb") as f:
+                        content = f.read()
+            except FileNotFoundError:
+                # Evicted by another process sharing the directory
+                with self._lock:
+                    self._forget(key)
+
+        if content is None:
+            if count:
+                self._count("misses")
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        if count:
+            self._count("hits")
+        return content
+
+    def put(self, key: str, content: bytes):
+        if not self.enabled or not content:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path) # Atomic so readers never see half an image
+
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(content)
+            self._bytes += len(content)
+            evicted = self._evict()
+
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            metrics.incr("generation_cache.evictions")
+
+    def _evict(self):
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._forget(key)
+            evicted.append(key)
+        return evicted
+
+    def _remove(self, key):
+        with self._lock:
+            self._forget(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+
+    def _count(self, outcome):
+        metrics.incr(f"generation_cache.{outcome}")
+        hits = metrics.get("generation_cache.hits")
+        metrics.set_gauge("generation_cache.hit_rate", hits / (hits + metrics.get("generation_cache.misses")))
+
+def _sha256(image):
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            image = f.read()
+        metrics.incr("pipeline.disk_reads")
+    return hashlib.sha256(image).hexdigest()
+
+generation_cache = GenerationCache()
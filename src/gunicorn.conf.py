@@ -0,0 +1,8 @@
+# Read by gunicorn from the working directory
+
+def post_worker_init(worker):
+    """
+        Starts the background services of app.py in each worker once it has loaded the app.
+    """
+    from app import start_services
+    start_services()
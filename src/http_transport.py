@@ -0,0 +1,60 @@
+import os
+import importlib.util
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from job_queue import JOB_WORKERS
+
+__all__ = ["session", "openai_http_client", "openai_async_http_client"]
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 120))
+# An image generation can take minutes and a timed out one is still billed and then retried,
+# so OpenAI calls get their own read timeout, by default the 600 seconds the SDK uses
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", 600))
+# Connections kept open per host, enough for every worker to have a couple of calls in flight
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", max(JOB_WORKERS, 1) * 4))
+# The asyncio engine keeps many more requests in flight without needing a thread for each
+HTTP_ASYNC_POOL_SIZE = int(os.getenv("HTTP_ASYNC_POOL_SIZE", 100))
+
+class TimeoutSession(requests.Session):
+    """
+        A requests Session that applies the default connect and read timeouts to every call
+        that doesn't set its own.
+    """
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+def _make_session():
+    s = TimeoutSession()
+    # One pool per host (Slack files, the Dropbox api/content/notify hosts), connections kept alive
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE, pool_block=False)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+# Shared by the Slack and Dropbox helpers so every call reuses warm TCP/TLS connections
+session = _make_session()
+
+def openai_http_client():
+    """
+        HTTP client for the OpenAI SDK with the same pool size, and OPENAI_READ_TIMEOUT as its read timeout.
+        The SDK takes its timeout from the client it is given.
+        Speaks HTTP/2 when the h2 package is installed.
+    """
+    return httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    )
+
+def openai_async_http_client():
+    """
+        Async counterpart of openai_http_client, for the asyncio job engine.
+    """
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=HTTP_ASYNC_POOL_SIZE, max_keepalive_connections=HTTP_ASYNC_POOL_SIZE),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    )
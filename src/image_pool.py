@@ -0,0 +1,177 @@
+import os
+import sys
+import asyncio
+import threading
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image
+from metrics import metrics
+from reformat_image import resize_image, resize_image_tiled, OUTPUT_SIZE, TILED_PNG_OPTIONS
+
+__all__ = ["render_outputs", "render_outputs_async"]
+
+# Processes that decode, crop, resize and encode outputs. 0 does the work on the calling thread.
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", os.cpu_count() or 2))
+# Outputs of at least this many pixels are resized and encoded in bands instead of as one full frame
+TILED_RESIZE_MIN_PIXELS = int(os.getenv("TILED_RESIZE_MIN_PIXELS", 16_000_000))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(size=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, as forking a process that already runs threads is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=size or IMAGE_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+def _preview_size(image_bytes, settings, max_side):
+    """
+        Size of a preview with the framing of the print master, scaled so its longest side is max_side
+        or the longest side of the cropped source, whichever is smaller. Only reads the image header.
+    """
+    margin = settings.get("crop_margin", 6)
+    source = Image.open(BytesIO(image_bytes)).size
+    side = min(max_side, max(source) - 2 * margin)
+
+    target = settings.get("new_size", OUTPUT_SIZE)
+    scale = side / max(target)
+    return (max(1, round(target[0] * scale)), max(1, round(target[1] * scale)))
+
+def _encode(image_bytes, settings, profile, stats):
+    buffer = BytesIO()
+    options = {key: value for key, value in profile.items() if key not in ("format", "extension", "max_side")}
+    settings = dict(settings)
+
+    if profile.get("max_side"):
+        settings["new_size"] = _preview_size(image_bytes, settings, profile["max_side"])
+        if profile["format"] == "JPEG":
+            settings["mode"] = "RGB"
+
+    # A profile with options the tiled encoder doesn't have, like optimize, gets the full frame path
+    width, height = settings.get("new_size", OUTPUT_SIZE)
+    if profile["format"] == "PNG" and width * height >= TILED_RESIZE_MIN_PIXELS and set(options) <= TILED_PNG_OPTIONS:
+        resize_image_tiled(image_bytes, buffer, stats=stats, **options, **settings)
+    else:
+        settings.pop("tile_height", None)
+        image = resize_image(image_bytes, stats=stats, **settings)
+        image.save(buffer, format=profile["format"], **options)
+
+    stats["bytes"] = buffer.tell()
+    return buffer
+
+def _share(image_bytes):
+    """
+        Copies the input into a shared memory block once, so it isn't pickled to the pool once per profile.
+        The caller owns the block and unlinks it when every profile is done.
+    """
+    shm = SharedMemory(create=True, size=max(len(image_bytes), 1))
+    shm.buf[:len(image_bytes)] = image_bytes
+    metrics.count_copy(len(image_bytes))
+    return shm
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    # Spawned workers report to the parent's resource tracker, which forgets the block when the parent unlinks it
+    return SharedMemory(name=name)
+
+def _render(name, size, settings, profile):
+    """
+        Runs in a pool process. Reads the input from the shared memory block of render_outputs
+        and returns the encoded image along with the resize stats.
+    """
+    shm = _attach(name)
+    try:
+        image_bytes = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+    stats = {}
+    return _encode(image_bytes, settings, profile, stats).getvalue(), stats
+
+def _collect(result, stats=None):
+    data, resize_stats = result
+    if stats is not None:
+        stats.update(resize_stats)
+    # Copied out of the encoder buffer in the pool process, then out of the pipe here
+    metrics.count_copy(len(data), 2)
+    return data
+
+def _gather(results, stats):
+    """
+        Collects the (name, result) pairs of one image, raising the first failure once every result is counted.
+    """
+    outputs = {}
+    error = None
+    for name, result in results:
+        if isinstance(result, BaseException):
+            error = error or result
+            continue
+        stats[name] = {}
+        outputs[name] = _collect(result, stats[name])
+        metrics.incr(f"encode.{name}.images")
+        metrics.incr(f"encode.{name}.bytes", stats[name].get("bytes", 0))
+
+    if error:
+        raise error
+    return outputs
+
+def render_outputs(image_bytes, profiles: dict, settings=None, stats=None):
+    """
+        Resizes the generated image and encodes it once per encoder profile, all profiles at the same time.
+        profiles maps a name to an encoder profile (see vars.ENCODER_PROFILES) and the encoded bytes are
+        returned under the same names. settings are passed on to resize_image (resample, mode, new_size...)
+        and stats receives the resize stats and encoded size of each profile under its name.
+        The work runs in the image pool so it doesn't compete for the GIL with the I/O threads.
+    """
+    settings = settings or {}
+    stats = {} if stats is None else stats
+    outputs = {}
+
+    if IMAGE_POOL_SIZE <= 0:
+        for name, profile in profiles.items():
+            stats[name] = {}
+            outputs[name] = _encode(image_bytes, settings, profile, stats[name]).getvalue()
+            metrics.count_copy(len(outputs[name]))
+            metrics.incr(f"encode.{name}.images")
+            metrics.incr(f"encode.{name}.bytes", stats[name]["bytes"])
+        return outputs
+
+    shm = _share(image_bytes)
+    try:
+        futures = {
+            name: _get_pool().submit(_render, shm.name, len(image_bytes), settings, profile)
+            for name, profile in profiles.items()
+        }
+        results = [(name, future.exception() or future.result()) for name, future in futures.items()]
+    finally:
+        shm.close()
+        shm.unlink()
+    return _gather(results, stats)
+
+async def render_outputs_async(image_bytes, profiles: dict, settings=None, stats=None):
+    """
+        Same as render_outputs, awaiting the pool instead of blocking a thread.
+    """
+    if IMAGE_POOL_SIZE <= 0:
+        return await asyncio.to_thread(render_outputs, image_bytes, profiles, settings, stats)
+
+    stats = {} if stats is None else stats
+    names = list(profiles)
+    shm = _share(image_bytes)
+    try:
+        results = await asyncio.gather(*(
+            asyncio.wrap_future(_get_pool().submit(_render, shm.name, len(image_bytes), settings or {}, profiles[name]))
+            for name in names
+        ), return_exceptions=True)
+    finally:
+        shm.close()
+        shm.unlink()
+    return _gather(zip(names, results), stats)
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+__all__ = ["JobQueue"]
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", 20))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 2))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2.0))
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+
+class JobQueue:
+    """
+        Persistent job queue backed by SQLite and served by a fixed pool of worker threads.
+        Jobs are stored as JSON payloads and handed to the handler one at a time per worker.
+        Jobs left running by a process that died are put back in the queue on start.
+    """
+    def __init__(self, handler, logger, db_path=JOB_DB_PATH, workers=JOB_WORKERS,
+                 max_depth=JOB_QUEUE_MAX_DEPTH, max_attempts=JOB_MAX_ATTEMPTS):
+        self.handler = handler # Callable that receives the decoded payload of a job
+        self.logger = logger
+        self.workers = workers
+        self.max_depth = max_depth # Number of queued jobs after which new work is rejected
+        self.max_attempts = max_attempts # Number of times an interrupted job is re-run
+
+        self._lock = threading.Lock() # Guards the shared connection
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._listeners = [] # Called whenever a job is enqueued
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._init_db()
+        self._recover()
+
+    def _init_db(self):
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner INTEGER,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def _recover(self):
+        """
+            Re-queues jobs whose owning process is no longer alive.
+            Jobs that have already used up their attempts are marked as failed so a job
+            that crashes the process cannot crash it forever.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, attempts, owner FROM jobs WHERE status = 'running'"
+            ).fetchall()
+
+            for job_id, attempts, owner in rows:
+                # A container restart can hand us the pid of the process that died
+                if owner and owner != os.getpid() and _pid_alive(owner):
+                    continue
+
+                if attempts < self.max_attempts:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE id = ?",
+                        (now, job_id)
+                    )
+                    self.logger.info(f"Recovered interrupted job {job_id}")
+                else:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                        ("Interrupted too many times", now, job_id)
+                    )
+                    self.logger.info(f"Giving up on interrupted job {job_id}")
+
+            # Forget finished jobs after a day so the database does not grow forever
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (now - JOB_RETENTION_SECONDS,)
+            )
+
+    def depth(self):
+        """
+            Returns the number of jobs waiting to be picked up by a worker.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def enqueue(self, payload: dict):
+        """
+            Adds a job to the queue. Returns the job id, or None if the queue is full.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                depth = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if depth >= self.max_depth:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                cursor = self._conn.execute(
+                    "INSERT INTO jobs (payload, created_at, updated_at) VALUES (?, ?, ?)",
+                    (json.dumps(payload), now, now)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        self._wakeup.set()
+        for listener in self._listeners:
+            listener()
+        return cursor.lastrowid
+
+    def add_listener(self, callback):
+        """
+            Registers a callback to run after every enqueue, for engines that don't use the worker threads.
+        """
+        self._listeners.append(callback)
+
+    def claim(self):
+        """
+            Atomically moves the oldest queued job to running and returns (id, payload).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, updated_at = ? WHERE id = ?",
+                        (os.getpid(), now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def finish(self, job_id, error=None):
+        """
+            Marks a claimed job as done, or as failed when an error is given.
+        """
+        status = "done" if error is None else "failed"
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self.claim()
+            if job is None:
+                # Poll as well as wait so jobs queued by other processes are picked up
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            job_id, payload = job
+            self.logger.info(f"Starting job {job_id}")
+            try:
+                self.handler(payload)
+                self.finish(job_id)
+                self.logger.info(f"Finished job {job_id}")
+            except Exception as e:
+                self.finish(job_id, str(e))
+                self.logger.info(f"Job {job_id} failed: {e}")
+
+    def start(self):
+        """
+            Starts the worker pool. Safe to call more than once.
+        """
+        if self._threads:
+            return
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
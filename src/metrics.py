@@ -0,0 +1,38 @@
+import threading
+
+__all__ = ["metrics"]
+
+class Metrics:
+    """
+        Thread safe counters and gauges shared by the app, the job workers and the helpers.
+        A snapshot is served as JSON from the /metrics route.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+
+    def incr(self, name: str, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def count_copy(self, size: int, copies=1):
+        """
+            Records copies of an image buffer of size bytes under pipeline.buffer_copies and pipeline.copied_bytes.
+        """
+        self.incr("pipeline.buffer_copies", copies)
+        self.incr("pipeline.copied_bytes", size * copies)
+
+    def get(self, name: str):
+        with self._lock:
+            return self._counters.get(name, self._gauges.get(name, 0))
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges)}
+
+metrics = Metrics()
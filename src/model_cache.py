@@ -0,0 +1,263 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from dropbox_helper import (
+    download_file_from_shared_folder,
+    get_file_metadata,
+    list_files_in_folder,
+    dropbox_content_hash
+)
+from metrics import metrics
+from reformat_image import normalize_image, INPUT_NORMALIZATION
+
+load_dotenv()
+
+__all__ = ["model_cache"]
+
+MODELS_FOLDER_ID = os.getenv("MODELS_FOLDER_ID")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "model_cache")
+MODEL_CACHE_DISK_BYTES = int(os.getenv("MODEL_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+MODEL_CACHE_MEMORY_BYTES = int(os.getenv("MODEL_CACHE_MEMORY_BYTES", 128 * 1024 * 1024))
+MODEL_CACHE_REVALIDATE_SECONDS = int(os.getenv("MODEL_CACHE_REVALIDATE_SECONDS", 15 * 60))
+
+class ModelImageCache:
+    """
+        Local cache of the model images stored in the Dropbox models folder.
+        Images are stored on disk and in memory under their Dropbox content_hash, both sides
+        evicting least recently used images once they go over their size limit.
+        Their normalized versions are stored the same way, under the content_hash and the normalization settings.
+        The path -> content_hash index is revalidated against Dropbox metadata every so often,
+        so a model image replaced in Dropbox is picked up without a restart.
+    """
+    def __init__(self, folder_id, cache_dir=MODEL_CACHE_DIR, max_disk_bytes=MODEL_CACHE_DISK_BYTES,
+                 max_memory_bytes=MODEL_CACHE_MEMORY_BYTES, revalidate_after=MODEL_CACHE_REVALIDATE_SECONDS):
+        self.folder_id = folder_id
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.revalidate_after = revalidate_after
+
+        self._lock = threading.Lock()
+        self._index = {} # path_lower -> {"content_hash", "rev", "size", "checked_at"}
+        self._memory = OrderedDict() # content_hash -> bytes, least recently used first
+        self._memory_bytes = 0
+        self._disk = OrderedDict() # content_hash -> size, least recently used first
+        self._disk_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_disk()
+
+    def _load_disk(self):
+        """
+            Picks up the images a previous process left in the cache directory, oldest access first.
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".png") and "-" in name:
+                # A normalized image from before these were stored without an extension
+                os.remove(path)
+                continue
+            if name.endswith(".png"):
+                key = name[:-4]
+            elif "." not in name:
+                key = name
+            else:
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_atime, key, stat.st_size))
+
+        for _, content_hash, size in sorted(files):
+            self._disk[content_hash] = size
+            self._disk_bytes += size
+
+    def _disk_path(self, key):
+        """
+            Originals, keyed by their content_hash, are PNGs. Normalized images, keyed by content_hash
+            and the normalization settings, can be any format normalize_image settles on, so they get no extension.
+        """
+        if "-" in key:
+            return os.path.join(self.cache_dir, key)
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def remember(self, entry: dict):
+        """
+            Records the content_hash and rev of a file from a Dropbox listing or metadata call.
+        """
+        with self._lock:
+            self._index[entry["path_lower"]] = {
+                "content_hash": entry["content_hash"],
+                "rev": entry.get("rev"),
+                "size": entry.get("size"),
+                "checked_at": time.monotonic()
+            }
+
+    def _lookup(self, file_path):
+        """
+            Returns the index entry of a file, asking Dropbox for its metadata if it is unknown or stale.
+            A stale entry is still used when Dropbox cannot be reached.
+        """
+        key = file_path.lower()
+        with self._lock:
+            entry = self._index.get(key)
+
+        if entry and time.monotonic() - entry["checked_at"] < self.revalidate_after:
+            return entry
+
+        metadata = get_file_metadata(self.folder_id, file_path)
+        metrics.incr("model_cache.revalidations")
+        if metadata.get("error") or "content_hash" not in metadata:
+            print(f"Could not revalidate {file_path}: {metadata}")
+            return entry
+
+        self.remember(metadata)
+        with self._lock:
+            return self._index[key]
+
+    def get(self, file_path: str, content_hash: str = None):
+        """
+            Returns the bytes of the model image at file_path, downloading it only if it is not cached.
+            Callers that already know the content_hash (e.g. from the model catalog) skip revalidation.
+            Returns None if the image can't be found or downloaded.
+        """
+        if content_hash:
+            entry = {"content_hash": content_hash}
+        else:
+            entry = self._lookup(file_path)
+        if entry:
+            content = self._read(entry["content_hash"])
+            if content is not None:
+                metrics.incr("model_cache.hits")
+                return content
+
+        metrics.incr("model_cache.misses")
+        res = download_file_from_shared_folder(self.folder_id, file_path)
+        content = res.get("content")
+        if content is None:
+            print(f"Downloading Model from Dropbox failed: {res}")
+            return None
+
+        content_hash = dropbox_content_hash(content)
+        if entry and entry["content_hash"] != content_hash:
+            # The file changed since it was indexed, trust what was actually downloaded
+            self.remember({"path_lower": file_path.lower(), "content_hash": content_hash, "size": len(content)})
+
+        self._store(content_hash, content)
+        return content
+
+    def get_normalized(self, file_path: str, content_hash: str = None):
+        """
+            Same as get, but returns the model image normalized for the image model.
+            The normalized image is cached next to the original, so each model image is normalized once.
+        """
+        if content_hash is None:
+            entry = self._lookup(file_path)
+            content_hash = entry and entry["content_hash"]
+
+        if content_hash:
+            content = self._read(f"{content_hash}-{INPUT_NORMALIZATION}")
+            if content is not None:
+                metrics.incr("model_cache.normalized_hits")
+                return content
+
+        original = self.get(file_path, content_hash)
+        if original is None:
+            return None
+
+        content = normalize_image(original)
+        self._store(f"{dropbox_content_hash(original)}-{INPUT_NORMALIZATION}", content)
+        metrics.incr("model_cache.normalized")
+        return content
+
+    def _read(self, content_hash):
+        with self._lock:
+            content = self._memory.get(content_hash)
+            if content is not None:
+                self._memory.move_to_end(content_hash)
+                return content
+
+            on_disk = content_hash in self._disk
+            if on_disk:
+                self._disk.move_to_end(content_hash)
+
+        if not on_disk:
+            return None
+
+        try:
+            with open(self._disk_path(content_hash), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            # Evicted by another process sharing the directory
+            with self._lock:
+                self._forget_disk(content_hash)
+            return None
+
+        with self._lock:
+            self._keep_in_memory(content_hash, content)
+        return content
+
+    def _store(self, content_hash, content):
+        path = self._disk_path(content_hash)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path) # Atomic so readers never see half an image
+
+        with self._lock:
+            if content_hash not in self._disk:
+                self._disk[content_hash] = len(content)
+                self._disk_bytes += len(content)
+            self._disk.move_to_end(content_hash)
+            self._keep_in_memory(content_hash, content)
+            self._evict_disk()
+
+    def _keep_in_memory(self, content_hash, content):
+        if content_hash in self._memory:
+            self._memory.move_to_end(content_hash)
+            return
+
+        self._memory[content_hash] = content
+        self._memory_bytes += len(content)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            content_hash = next(iter(self._disk))
+            self._forget_disk(content_hash)
+            try:
+                os.remove(self._disk_path(content_hash))
+            except FileNotFoundError:
+                pass
+            metrics.incr("model_cache.evictions")
+
+    def _forget_disk(self, content_hash):
+        size = self._disk.pop(content_hash, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def warm_up(self, entries: list = None):
+        """
+            Downloads every model image that is not cached yet.
+            Takes the entries of an existing listing, or lists the whole models folder itself.
+            Meant to run once in the background at startup.
+        """
+        if entries is None:
+            listing = list_files_in_folder(self.folder_id, "", recursive=True)
+            if listing.get("error"):
+                print(f"Model cache warm up failed: {listing}")
+                return
+            entries = listing["entries"]
+
+        for entry in entries:
+            if not entry["path_lower"].endswith(".png"):
+                continue
+            self.remember(entry)
+            self.get_normalized(entry["path_display"], entry["content_hash"])
+
+        print(f"Model cache warmed up with {len(entries)} images")
+
+model_cache = ModelImageCache(MODELS_FOLDER_ID)
@@ -0,0 +1,138 @@
+import os
+import time
+import random
+import threading
+from dotenv import load_dotenv
+from dropbox_helper import list_files_in_folder, list_folder_changes, longpoll_folder
+from model_cache import model_cache
+from metrics import metrics
+
+load_dotenv()
+
+__all__ = ["model_catalog"]
+
+MODELS_FOLDER_ID = os.getenv("MODELS_FOLDER_ID")
+MODEL_CATALOG_LONGPOLL_TIMEOUT = int(os.getenv("MODEL_CATALOG_LONGPOLL_TIMEOUT", 120))
+
+class ModelCatalog:
+    """
+        In-process index of the model images in the Dropbox models folder, bucketed by (sex, color).
+        Built once with a recursive listing and kept current by long-polling the listing cursor,
+        so model images added in Dropbox show up without a restart.
+    """
+    def __init__(self, folder_id):
+        self.folder_id = folder_id
+
+        self._lock = threading.Lock()
+        self._files = {} # path_lower -> entry
+        self._buckets = {} # (sex, color) -> list of entries, rebuilt when the folder changes
+        self._cursor = None
+        self._thread = None
+
+    def _bucket_of(self, path_lower):
+        # /{sex}/{color}/{n}.png
+        parts = path_lower.strip("/").split("/")
+        if len(parts) != 3 or not parts[2].endswith(".png"):
+            return None
+        return parts[0], parts[1]
+
+    def _rebuild_buckets(self):
+        buckets = {}
+        for entry in self._files.values():
+            buckets.setdefault(self._bucket_of(entry["path_lower"]), []).append(entry)
+        self._buckets = buckets
+        metrics.set_gauge("model_catalog.files", len(self._files))
+
+    def _apply(self, entries):
+        """
+            Applies entries from a listing or a change feed to the index.
+        """
+        with self._lock:
+            for entry in entries:
+                path = entry["path_lower"]
+                if entry[".tag"] == "file" and self._bucket_of(path):
+                    self._files[path] = entry
+                elif entry[".tag"] == "deleted":
+                    # A deleted folder removes everything under it
+                    for known in [p for p in self._files if p == path or p.startswith(path + "/")]:
+                        del self._files[known]
+            self._rebuild_buckets()
+
+        for entry in entries:
+            if entry[".tag"] == "file" and self._bucket_of(entry["path_lower"]):
+                model_cache.remember(entry)
+
+    def build(self):
+        """
+            Indexes the whole models folder. Returns True on success.
+        """
+        listing = list_files_in_folder(self.folder_id, "", recursive=True)
+        if listing.get("error"):
+            print(f"Model catalog could not be built: {listing}")
+            return False
+
+        with self._lock:
+            self._files = {}
+        self._apply(listing["entries"])
+        self._cursor = listing["cursor"]
+        print(f"Model catalog built with {len(self._files)} images")
+        return True
+
+    def sync(self):
+        """
+            Fetches the changes since the last build or sync and applies them.
+        """
+        changes = list_folder_changes(self.folder_id, self._cursor)
+        if changes.get("error"):
+            print(f"Model catalog sync failed: {changes}")
+            return False
+
+        self._apply(changes["entries"])
+        self._cursor = changes["cursor"]
+        metrics.incr("model_catalog.syncs")
+        return True
+
+    def entries(self):
+        with self._lock:
+            return list(self._files.values())
+
+    def select(self, sex: str, color: str):
+        """
+            Picks a random model image of the bucket. Returns None if the bucket is empty or unknown.
+        """
+        with self._lock:
+            bucket = self._buckets.get((sex, color))
+            if not bucket:
+                return None
+            return random.choice(bucket)
+
+    def _watch(self):
+        while not self.build():
+            time.sleep(30)
+
+        model_cache.warm_up(self.entries())
+
+        while True:
+            result = longpoll_folder(self._cursor, MODEL_CATALOG_LONGPOLL_TIMEOUT)
+            if result.get("error"):
+                print(f"Model catalog longpoll failed: {result}")
+                time.sleep(30)
+                continue
+
+            if result.get("changes") and not self.sync():
+                # The cursor may have expired, start over from a full listing
+                self.build()
+
+            if result.get("backoff"):
+                time.sleep(result["backoff"])
+
+    def start(self):
+        """
+            Builds the catalog, warms the model cache and keeps both current in a background thread.
+        """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._watch, name="model-catalog", daemon=True)
+        self._thread.start()
+
+model_catalog = ModelCatalog(MODELS_FOLDER_ID)
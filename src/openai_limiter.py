@@ -0,0 +1,255 @@
+import os
+import re
+import time
+import random
+import asyncio
+import threading
+import openai
+from metrics import metrics
+
+__all__ = ["openai_limiter", "job_deadline", "DeadlineExceeded"]
+
+# Concurrent OpenAI calls the limiter starts with and the range it adapts within
+OPENAI_CONCURRENCY_START = int(os.getenv("OPENAI_CONCURRENCY_START", 4))
+OPENAI_CONCURRENCY_MIN = int(os.getenv("OPENAI_CONCURRENCY_MIN", 1))
+OPENAI_CONCURRENCY_MAX = int(os.getenv("OPENAI_CONCURRENCY_MAX", 32))
+# Time a job gets for its generation, waiting and retries included
+OPENAI_JOB_DEADLINE_SECONDS = float(os.getenv("OPENAI_JOB_DEADLINE_SECONDS", 10 * 60))
+OPENAI_BACKOFF_BASE_SECONDS = float(os.getenv("OPENAI_BACKOFF_BASE_SECONDS", 2))
+OPENAI_BACKOFF_MAX_SECONDS = float(os.getenv("OPENAI_BACKOFF_MAX_SECONDS", 60))
+
+# Failures that mean OpenAI is busy rather than that the request is wrong, except 429s for an exhausted quota
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+class DeadlineExceeded(Exception):
+    """
+        Raised when a call can't be made or retried before the deadline of its job.
+    """
+
+def job_deadline():
+    """
+        Deadline, as a time.monotonic() value, for the OpenAI calls of a job starting now.
+    """
+    return time.monotonic() + OPENAI_JOB_DEADLINE_SECONDS
+
+def parse_duration(value):
+    """
+        Converts the durations in OpenAI's rate limit headers, like "6m0s" or "250ms", to seconds.
+    """
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+class AdaptiveLimiter:
+    """
+        Caps the OpenAI calls in flight at a limit that adapts like TCP congestion control (AIMD):
+        every success adds 1 / limit, so the limit grows by about one per round of calls, and a
+        rate limit or timeout halves it, at most once per round. When the rate limit headers say no
+        requests are left, new calls wait for the reset instead of spending an attempt on a 429.
+
+        Calls go through call or call_async, which retry busy errors with jittered exponential
+        backoff until the deadline of the job. Threads and the asyncio engine share one limiter.
+    """
+    def __init__(self, start=OPENAI_CONCURRENCY_START, minimum=OPENAI_CONCURRENCY_MIN, maximum=OPENAI_CONCURRENCY_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(start, minimum), maximum))
+        self.in_flight = 0
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._async_waiters = [] # (loop, future) of coroutines waiting for a slot
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("openai.in_flight", self.in_flight)
+        metrics.set_gauge("openai.limit", round(self.limit, 2))
+
+    def _wait_time(self):
+        """
+            Seconds until a slot may be taken, 0 if one is free now, None if every slot is taken.
+        """
+        paused = self._paused_until - time.monotonic()
+        if paused > 0:
+            return paused
+        return 0 if self.in_flight < int(self.limit) else None
+
+    def _take(self):
+        self.in_flight += 1
+        self._publish()
+        return time.monotonic()
+
+    def acquire(self, deadline):
+        """
+            Waits for a slot and returns when the call started.
+        """
+        with self._available:
+            while (wait := self._wait_time()) != 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("No OpenAI capacity before the job deadline")
+                self._available.wait(min(remaining, wait) if wait else remaining)
+            return self._take()
+
+    async def acquire_async(self, deadline):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+                if wait == 0:
+                    return self._take()
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("No OpenAI capacity before the job deadline")
+            try:
+                await asyncio.wait_for(future, min(remaining, wait) if wait else remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._publish()
+            self._wake()
+
+    def _wake(self):
+        self._available.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+        self._async_waiters = []
+
+    def on_success(self, headers):
+        with self._lock:
+            remaining = _header_int(headers, "x-ratelimit-remaining-requests")
+            if remaining == 0:
+                self._pause(parse_duration(headers.get("x-ratelimit-reset-requests")))
+            elif remaining is None or remaining > self.in_flight:
+                # Only grow while the quota has room for more than is already in flight
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._publish()
+            self._wake()
+
+    def on_busy(self, started_at, retry_after=None):
+        """
+            Halves the limit, unless it was already halved after this call started.
+        """
+        with self._lock:
+            if started_at > self._last_decrease:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = time.monotonic()
+            self._pause(retry_after)
+            self._publish()
+        metrics.incr("openai.throttled")
+
+    def _pause(self, seconds):
+        if seconds:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _backoff(self, attempt, retry_after, deadline, error):
+        delay = random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+        delay = max(delay, retry_after or 0)
+        if time.monotonic() + delay >= deadline:
+            metrics.incr("openai.deadline_exceeded")
+            raise DeadlineExceeded(f"OpenAI is busy and the job deadline is near: {error}") from error
+
+        metrics.incr("openai.retries")
+        print(f"OpenAI is busy, retrying in {delay:.1f}s: {error}")
+        return delay
+
+    def call(self, request, deadline=None, consume=None):
+        """
+            Makes request(), which must return a raw response of the OpenAI SDK (with_raw_response),
+            and returns the parsed response, or what consume returns for it.
+            consume runs while the slot is still held, so a streamed response counts as in flight until read.
+        """
+        deadline = deadline or job_deadline()
+        attempt = 0
+        while True:
+            started_at = self.acquire(deadline)
+            try:
+                raw = request()
+                self.on_success(raw.headers)
+                response = raw.parse()
+                return consume(response) if consume else response
+            except RETRYABLE_ERRORS as e:
+                if _out_of_quota(e):
+                    raise
+                retry_after = _retry_after(e)
+                self.on_busy(started_at, retry_after)
+                delay = self._backoff(attempt, retry_after, deadline, e)
+            finally:
+                self.release()
+
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, request, deadline=None, consume=None):
+        """
+            Same as call, for a coroutine function request and coroutine function consume.
+        """
+        deadline = deadline or job_deadline()
+        attempt = 0
+        while True:
+            started_at = await self.acquire_async(deadline)
+            try:
+                raw = await request()
+                self.on_success(raw.headers)
+                response = raw.parse()
+                return await consume(response) if consume else response
+            except RETRYABLE_ERRORS as e:
+                if _out_of_quota(e):
+                    raise
+                retry_after = _retry_after(e)
+                self.on_busy(started_at, retry_after)
+                delay = self._backoff(attempt, retry_after, deadline, e)
+            finally:
+                self.release()
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+def _out_of_quota(error):
+    """
+        A 429 for an exhausted quota or billing limit, which no amount of waiting or backing off fixes.
+    """
+    return isinstance(error, openai.RateLimitError) and getattr(error, "code", None) == "insufficient_quota"
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after(error):
+    """
+        Seconds the server asked to wait before retrying, from the response of a failed call.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            return None
+    if _header_int(headers, "x-ratelimit-remaining-requests") == 0:
+        return parse_duration(headers.get("x-ratelimit-reset-requests"))
+    return None
+
+openai_limiter = AdaptiveLimiter()
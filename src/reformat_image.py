@@ -1,25 +1,254 @@
-from PIL import Image
+from PIL import Image, ImageOps, ImageCms
 import os
+import time
+import zlib
+import struct
 import pathlib
 import numpy as np
 
 from io import BytesIO
+from metrics import metrics
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS
+}
+
+# Filter used when the channel doesn't ask for one, bicubic is what Image.resize has always used here
+RESIZE_RESAMPLE = os.getenv("RESIZE_RESAMPLE", "bicubic")
+# Print size of the outputs when the channel doesn't set new_size
+OUTPUT_SIZE = (4200, 5400)
+# Output rows resized and encoded at a time by resize_image_tiled
+TILE_HEIGHT = int(os.getenv("TILE_HEIGHT", 256))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+# Size of the IDAT chunks written by resize_image_tiled
+PNG_CHUNK_BYTES = 1024 * 1024
+# Rows filtered together, the filter works in int16 copies so this bounds its scratch space
+PNG_FILTER_ROWS = 16
+# Image.save PNG options resize_image_tiled supports as well
+TILED_PNG_OPTIONS = {"compress_level", "dpi"}
+
+# How designs and model images are sent to the image model: no side longer than INPUT_MAX_SIDE,
+# as the model doesn't look at more, encoded as INPUT_FORMAT (webp, png or jpeg) at INPUT_QUALITY
+INPUT_MAX_SIDE = int(os.getenv("INPUT_MAX_SIDE", 1536))
+INPUT_FORMAT = os.getenv("INPUT_FORMAT", "webp")
+INPUT_QUALITY = int(os.getenv("INPUT_QUALITY", 90))
+# Tells normalized images made with different settings apart in caches
+INPUT_NORMALIZATION = f"{INPUT_FORMAT}-{INPUT_MAX_SIDE}-q{INPUT_QUALITY}"
+
+def resize_image(image, new_size: tuple = OUTPUT_SIZE, crop_margin=6, resample=RESIZE_RESAMPLE, mode=None, stats=None):
+    """
+        Crops crop_margin pixels off every side of the image and resizes it to new_size.
+        The image can be raw bytes (from base64 or download) or an opened PIL image.
+
+        The crop is folded into the resize through its box argument, so no cropped copy is made,
+        and JPEG sources that are bigger than needed are decoded at a reduced size.
+        mode converts the output (e.g. "RGB" to drop an alpha channel nobody prints, compositing onto white)
+        before the resize, while the image is still small. When stats is a dict it receives the time taken and an
+        estimate of the peak bytes held in image buffers during the call.
+    """
+    start = time.perf_counter()
+    image, box, peak = _prepare(image, new_size, crop_margin, mode)
+
+    resized = image.resize(new_size, resample=RESAMPLE_FILTERS[resample], box=box)
+    peak += _buffer_bytes(resized)
+
+    if stats is not None:
+        stats["seconds"] = time.perf_counter() - start
+        stats["peak_bytes"] = peak
+    return resized
+
+def resize_image_tiled(image, out, new_size: tuple = OUTPUT_SIZE, crop_margin=6, resample=RESIZE_RESAMPLE,
+                       mode=None, tile_height=TILE_HEIGHT, compress_level=6, dpi=None, stats=None):
+    """
+        Same crop and resize as resize_image, written to the file object out as a PNG
+        without ever holding the full size image.
+
+        The output is produced tile_height rows at a time, each band resized from the matching part
+        of the source (the filter still reads the source rows around it) and compressed into the PNG
+        stream before the next one is made. Peak memory is a few bands plus the source, whatever new_size is.
+        The pixels match a full frame resize up to rounding, a level or so in alpha and premultiplied color.
+        The stored color of nearly transparent pixels can be much further off, but it barely shows.
+        bench_tiled_resize.py checks this.
+    """
+    start = time.perf_counter()
+    image, box, peak = _prepare(image, new_size, crop_margin, mode)
+    if image.mode not in PNG_COLOR_TYPES:
+        converted = image.convert("RGBA" if "transparency" in image.info or "A" in image.getbands() else "RGB")
+        peak += _buffer_bytes(converted)
+        image = converted
+
+    width, height = new_size
+    scale = (box[3] - box[1]) / height
+    band_peak = 0
+
+    out.write(PNG_SIGNATURE)
+    _write_chunk(out, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[image.mode], 0, 0, 0))
+    if dpi:
+        # pHYs is in pixels per metre
+        _write_chunk(out, b"pHYs", struct.pack(">IIB", *(round(d / 0.0254) for d in dpi), 1))
+
+    compressor = zlib.compressobj(compress_level)
+    pending = []
+    pending_bytes = 0
+    previous = np.zeros((1, width * len(image.getbands())), dtype=np.uint8) # Row above the band
+
+    for top in range(0, height, tile_height):
+        rows = min(tile_height, height - top)
+        band = image.resize(
+            (width, rows),
+            resample=RESAMPLE_FILTERS[resample],
+            box=(box[0], box[1] + top * scale, box[2], box[1] + (top + rows) * scale)
+        )
+
+        pixels = np.asarray(band, dtype=np.uint8).reshape(rows, -1)
+        for first in range(0, rows, PNG_FILTER_ROWS):
+            group = pixels[first:first + PNG_FILTER_ROWS]
+            data = compressor.compress(_filter_rows(group, previous, len(image.getbands())).tobytes())
+            previous = group[-1:]
+            if data:
+                pending.append(data)
+                pending_bytes += len(data)
+        previous = previous.copy() # Let the band go
+        band_peak = max(band_peak, _buffer_bytes(band) * 2 + PNG_FILTER_ROWS * pixels.shape[1] * 32)
+
+        if pending_bytes >= PNG_CHUNK_BYTES:
+            _write_chunk(out, b"IDAT", b"".join(pending))
+            pending, pending_bytes = [], 0
+
+    pending.append(compressor.flush())
+    _write_chunk(out, b"IDAT", b"".join(pending))
+    _write_chunk(out, b"IEND", b"")
+
+    if stats is not None:
+        stats["seconds"] = time.perf_counter() - start
+        stats["peak_bytes"] = peak + band_peak
+        stats["tiled"] = True
+
+def _prepare(image, new_size, crop_margin, mode):
+    """
+        Opens and decodes the image for a resize to new_size.
+        Returns the image, the crop box to resize from and the bytes held so far.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(BytesIO(image))
 
-def resize_image(image_bytes, new_size: tuple = (4200, 5400), crop_margin=6):
-    # Suppose image_bytes contains your raw bytes (from base64 or download)
-    image = Image.open(BytesIO(image_bytes))
     width, height = image.size
-    top, left = crop_margin, crop_margin
+    box = (crop_margin, crop_margin, width - crop_margin, height - crop_margin)
+
+    if image.format == "JPEG":
+        # Let the decoder scale by 1/2, 1/4 or 1/8 while still giving at least the pixels the output needs
+        needed = (
+            -(-width * new_size[0] // (box[2] - box[0])),
+            -(-height * new_size[1] // (box[3] - box[1]))
+        )
+        image.draft(image.mode, needed)
+        scale = image.size[0] / width
+        box = tuple(round(edge * scale) for edge in box)
+
+    image.load()
+    peak = _buffer_bytes(image)
+
+    if mode == "RGB" and (image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info):
+        # Dropping the alpha channel as is would show whatever color transparent pixels hold, often black
+        rgba = image.convert("RGBA")
+        converted = Image.new("RGB", image.size, "white")
+        converted.paste(rgba, mask=rgba)
+        peak += _buffer_bytes(rgba) + _buffer_bytes(converted)
+        image = converted
+    elif mode and image.mode != mode:
+        converted = image.convert(mode)
+        peak += _buffer_bytes(converted)
+        image = converted
+
+    return image, box, peak
+
+def _filter_rows(pixels, previous, bpp):
+    """
+        PNG filters a band of rows given the row above it. Every row gets whichever of the five
+        filters leaves the smallest sum of absolute values, the heuristic libpng and Pillow use,
+        and is returned prefixed with its filter type byte.
+    """
+    x = pixels.astype(np.int16)
+    b = np.vstack((previous, pixels[:-1])).astype(np.int16) # Above
+    a = np.zeros_like(x) # Left
+    a[:, bpp:] = x[:, :-bpp]
+    c = np.zeros_like(x) # Above left
+    c[:, bpp:] = b[:, :-bpp]
+
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+    candidates = np.stack((x, x - a, x - b, x - (a + b) // 2, x - paeth)).astype(np.uint8)
+    # Score the bytes as signed values, so small negative differences count as small
+    scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = scores.argmin(axis=0)
+
+    filtered = np.empty((len(pixels), pixels.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = best
+    filtered[:, 1:] = candidates[best, np.arange(len(pixels))]
+    return filtered
+
+def _write_chunk(out, chunk_type, data):
+    out.write(struct.pack(">I", len(data)))
+    out.write(chunk_type)
+    out.write(data)
+    out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+def normalize_image(image, max_side=INPUT_MAX_SIDE, image_format=INPUT_FORMAT, quality=INPUT_QUALITY):
+    """
+        Prepares an image (bytes or a path) for the image model. It is rotated upright from its EXIF
+        orientation, converted to sRGB, scaled down to fit max_side and re-encoded without metadata.
+        The original bytes are returned when they are already smaller, carry no metadata and need no rotation or scaling.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        image = pathlib.Path(image).read_bytes()
+
+    source = Image.open(BytesIO(image))
+    source_format = source.format
+    # Read before draft, which shrinks the size of JPEGs it decodes at a reduced scale.
+    # exif_transpose always returns a copy, so ask the orientation tag directly.
+    untouched = source.getexif().get(0x0112, 1) == 1 and max(source.size) <= max_side
+    # The original can only stand in for the re-encoded image if it has no metadata to strip
+    has_metadata = any(key in source.info for key in ("exif", "xmp", "XML:com.adobe.xmp"))
+    source.draft("RGB", (max_side, max_side))
+
+    upright = ImageOps.exif_transpose(source)
+
+    icc_profile = upright.info.get("icc_profile")
+    has_alpha = upright.mode in ("RGBA", "LA", "PA") or "transparency" in upright.info
+    converted = upright.convert("RGBA" if has_alpha and image_format != "jpeg" else "RGB")
+
+    if icc_profile:
+        try:
+            converted = ImageCms.profileToProfile(
+                converted, ImageCms.ImageCmsProfile(BytesIO(icc_profile)), ImageCms.createProfile("sRGB")
+            )
+        except (ImageCms.PyCMSError, OSError) as e:
+            print(f"Could not convert the image to sRGB, keeping its colors: {e}")
 
-    bottom = height - crop_margin
-    right = width - crop_margin
+    converted.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
 
-    image = np.array(image)
+    buffer = BytesIO()
+    if image_format == "png":
+        converted.save(buffer, format="PNG", optimize=True)
+    else:
+        converted.save(buffer, format=image_format.upper(), quality=quality)
 
-    image = image[top:bottom, left:right]
+    if untouched and not has_metadata and not icc_profile and source_format in ("PNG", "JPEG", "WEBP") and len(image) <= buffer.tell():
+        return bytes(image)
+    metrics.count_copy(buffer.tell())
+    return buffer.getvalue()
 
-    image = Image.fromarray(image)
-    return image.resize(new_size)
+def _buffer_bytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
 
 def main():
     images = os.listdir("image_outputs")
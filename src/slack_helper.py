@@ -1,8 +1,11 @@
 import os
+import time
 import requests
 from dotenv import load_dotenv
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from metrics import metrics
+from http_transport import session
 
 load_dotenv()
 
@@ -10,13 +13,46 @@ __all__ = [
     "get_channel_id",
     "send_message",
     "download_slack_file",
-    "send_file"
+    "send_file",
+    "upload_file",
+    "post_image",
+    "delete_message",
+    "delete_file",
+    "SlackDownloadError"
 ]
 
 SLACK_TOKEN = os.getenv("SLACK_TOKEN")
 
 client = WebClient(token=SLACK_TOKEN, timeout=180)
 
+SLACK_DOWNLOAD_MAX_BYTES = int(os.getenv("SLACK_DOWNLOAD_MAX_BYTES", 25 * 1024 * 1024))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+# Leading bytes of the image formats the image generator accepts
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif")
+]
+
+class SlackDownloadError(Exception):
+    """
+        Raised when a file shared in Slack can't be used, before any money is spent on it.
+    """
+
+def sniff_image_format(head: bytes):
+    """
+        Returns the image format from the first bytes of a file, or None if it is not a supported image.
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
 def get_all_channel_ids():
     channels = {}
     try:
@@ -43,45 +79,164 @@ def get_channel_id(channel_name):
     except SlackApiError as e:
         print(f"Error: {e}")
 
-def send_message(channel_id, message):
+def send_message(channel_id, message, thread_ts=None):
+    """
+        Posts a message to the channel, or as a reply in the thread of thread_ts.
+        Returns the ts of the message, or None if it could not be posted.
+    """
     try:
         # Call the conversations.list method using the WebClient
         result = client.chat_postMessage(
             channel=channel_id,
-            text=message
+            text=message,
+            thread_ts=thread_ts
             # You could also use a blocks[] array to send richer content
         )
+        return result["ts"]
+
+    except SlackApiError as e:
+        print(f"Error: {e}")
 
+def delete_file(file_id):
+    """
+        Deletes a file the bot uploaded. Returns whether it worked.
+    """
+    try:
+        client.files_delete(file=file_id)
+        return True
     except SlackApiError as e:
         print(f"Error: {e}")
+        return False
+
+def upload_file(filename, content: bytes, title="Preview"):
+    """
+        Uploads bytes without sharing them in any channel, to be shown in a message with post_image.
+        Returns {"file_id"}, or {"error", "details"} if the upload failed.
+    """
+    try:
+        response = client.files_upload_v2(content=content, filename=os.path.basename(filename), title=title)
+        return {"message": "File uploaded successfully", "file_id": response["file"]["id"]}
+    except SlackApiError as e:
+        print(f"Error uploading file: {e}")
+        return {"error": "Failed to upload file to Slack", "details": str(e)}
+
+def image_blocks(message, file_id):
+    return [
+        {"type": "section", "text": {"type": "mrkdwn", "text": message}},
+        {"type": "image", "slack_file": {"id": file_id}, "alt_text": "Preview"}
+    ]
 
-def download_slack_file(file_url, local_filename, token=SLACK_TOKEN):
+def post_image(channel_id, message, file_id, ts=None, thread_ts=None, attempts=4, delay=0.5):
+    """
+        Shows an uploaded file under message, in the message ts when given or else in a new one,
+        posted in the thread of thread_ts. Returns the ts of the message, or None if it failed.
+        Slack processes uploads in the background and rejects the image until it is done, so that is retried.
+    """
+    for attempt in range(attempts):
+        try:
+            blocks = image_blocks(message, file_id)
+            if ts:
+                client.chat_update(channel=channel_id, ts=ts, text=message, blocks=blocks)
+                return ts
+            return client.chat_postMessage(channel=channel_id, text=message, blocks=blocks, thread_ts=thread_ts)["ts"]
+        except SlackApiError as e:
+            if e.response.get("error") != "invalid_blocks" or attempt == attempts - 1:
+                print(f"Error: {e}")
+                return None
+        time.sleep(delay * 2 ** attempt)
+
+def delete_message(channel_id, ts):
+    try:
+        client.chat_delete(channel=channel_id, ts=ts)
+        return True
+    except SlackApiError as e:
+        print(f"Error: {e}")
+        return False
+
+def download_slack_file(file_url, local_filename=None, token=SLACK_TOKEN, max_bytes=SLACK_DOWNLOAD_MAX_BYTES):
+    """
+        Streams a file shared in Slack.
+        Returns the file bytes, or writes each chunk to local_filename as it arrives when one is given.
+        Raises SlackDownloadError as soon as the file turns out to be too big or not an image.
+    """
     headers = {
         "Authorization": f"Bearer {token}"
     }
 
-    response = requests.get(file_url, headers=headers)
-    if response.status_code == 200:
-        with open(local_filename, "wb") as f:
-            f.write(response.content)
-        print(f"Saved to {local_filename}")
-    else:
-        print(f"Failed to download: {response.status_code}, {response.text}")
+    try:
+        response = session.get(file_url, headers=headers, stream=True)
+    except requests.RequestException as e:
+        raise SlackDownloadError(f"The file could not be downloaded: {e}")
+
+    with response:
+        if response.status_code != 200:
+            raise SlackDownloadError(f"The file could not be downloaded (status {response.status_code})")
+
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if content_length > max_bytes:
+            raise SlackDownloadError(f"The file is {content_length // (1024 * 1024)} MB, the limit is {max_bytes // (1024 * 1024)} MB")
 
-def send_file(channel_id, filename, message="Here’s an AI-generated Image! 🎨"):
-    with open(filename, "rb") as f:
+        chunks = []
+        size = 0
+        out = open(local_filename, "wb") if local_filename else None
         try:
-            response = client.files_upload_v2(
-                channel=channel_id,
-                initial_comment=message,
-                file_uploads=[
-                    {
-                        "file": f,
-                        "filename": filename,
-                        "title": "Generated Image"
-                    }
-                ]
-            )
-            print(f"Upload successful! File ID: {response['file']['id']}")
-        except Exception as e:
-            print(f"Error uploading file: {e}")
\ No newline at end of file
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                if not size and not sniff_image_format(chunk[:12]):
+                    # Slack serves an HTML login page when the token can't see the file
+                    raise SlackDownloadError("The file is not a PNG, JPEG, GIF or WEBP image")
+
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SlackDownloadError(f"The file is over the {max_bytes // (1024 * 1024)} MB limit")
+
+                if out:
+                    out.write(chunk)
+                else:
+                    chunks.append(chunk)
+
+            if not size:
+                raise SlackDownloadError("The file is empty")
+        except BaseException:
+            if out:
+                out.close()
+                os.remove(local_filename)
+            raise
+
+    if out is None:
+        metrics.count_copy(size)
+        return b"".join(chunks)
+
+    out.close()
+    metrics.incr("pipeline.disk_writes")
+    print(f"Saved to {local_filename}")
+    return local_filename
+
+def send_file(channel_id, filename, message="Here’s an AI-generated Image! 🎨", content=None, thread_ts=None):
+    """
+        Uploads a file to the channel, or into the thread of thread_ts. Pass content to upload bytes
+        that are already in memory, otherwise the file at filename is read from disk.
+    """
+    upload = {
+        "filename": os.path.basename(filename),
+        "title": "Generated Image"
+    }
+
+    try:
+        if content is None:
+            with open(filename, "rb") as f:
+                upload["content"] = f.read()
+            metrics.incr("pipeline.disk_reads")
+        else:
+            upload["content"] = content
+
+        response = client.files_upload_v2(
+            channel=channel_id,
+            initial_comment=message,
+            file_uploads=[upload],
+            thread_ts=thread_ts
+        )
+        print(f"Upload successful! File ID: {response['file']['id']}")
+        return {"message": "File uploaded successfully", "file_id": response['file']['id']}
+    except Exception as e:
+        print(f"Error uploading file: {e}")
+        return {"error": "Failed to upload file to Slack", "details": str(e)}
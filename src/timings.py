@@ -0,0 +1,65 @@
+import time
+import threading
+from contextlib import contextmanager
+
+__all__ = ["JobTimings"]
+
+class JobTimings:
+    """
+        Records when each stage of a job started and ended, and which stages it waited for.
+        The report lists every stage and the critical path: the chain of stages that set the total time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._stages = {} # name -> (start, end, after)
+
+    @contextmanager
+    def stage(self, name: str, after: tuple = ()):
+        """
+            Times the body of the with block as the stage name, which depends on the stages in after.
+        """
+        start = time.perf_counter() - self._origin
+        try:
+            yield
+        finally:
+            end = time.perf_counter() - self._origin
+            with self._lock:
+                self._stages[name] = (start, end, tuple(after))
+
+    def mark(self, name: str, after: tuple = ()):
+        """
+            Records a moment, like the first preview reaching the user, as a stage of no length.
+            Only the first mark of a name counts. Returns the time of the mark in ms since the job started.
+        """
+        now = time.perf_counter() - self._origin
+        with self._lock:
+            start, _, _ = self._stages.setdefault(name, (now, now, tuple(after)))
+        return start * 1000
+
+    def critical_path(self):
+        """
+            Walks back from the stage that ended last, always through the dependency that ended last.
+        """
+        with self._lock:
+            stages = dict(self._stages)
+
+        if not stages:
+            return []
+
+        path = []
+        name = max(stages, key=lambda n: stages[n][1])
+        while name:
+            path.append(name)
+            deps = [d for d in stages[name][2] if d in stages]
+            name = max(deps, key=lambda d: stages[d][1]) if deps else None
+        return path[::-1]
+
+    def report(self):
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: item[1][0])
+
+        lines = [f"{name}: {start * 1000:.0f}ms -> {end * 1000:.0f}ms ({(end - start) * 1000:.0f}ms)"
+                 for name, (start, end, _) in stages]
+        lines.append(f"critical path: {' -> '.join(self.critical_path())}")
+        return "\n".join(lines)
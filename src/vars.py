@@ -1,7 +1,8 @@
 import os
+import json
 from dotenv import load_dotenv
 
-__all__ = ["CHANNEL_MAP"]
+__all__ = ["CHANNEL_MAP", "MODEL_ATTRIBUTES", "CHANNEL_RESIZE_SETTINGS", "ENCODER_PROFILES", "OUTPUT_PROFILES"]
 
 VALID_CHANNEL_1 = os.getenv("VALID_CHANNEL_1")
 DROPBOX_1 = str(os.getenv("DROPBOX_1"))
@@ -32,4 +33,37 @@ CHANNEL_MAP = {
     VALID_CHANNEL_5: DROPBOX_5,
     VALID_CHANNEL_6: DROPBOX_6,
     VALID_CHANNEL_7: DROPBOX_7
-}
\ No newline at end of file
+}
+
+# Attributes a user can ask for with --attributes {sex, shirt-color}.
+# They match the /{sex}/{color}/ folder layout of the models folder in Dropbox.
+MODEL_ATTRIBUTES = {
+    "sex": ["female", "male"],
+    "shirt-color": ["white", "black", "red", "blue"]
+}
+
+# Per channel overrides for reformat_image.resize_image, keyed by channel id, e.g.
+# {"C0123456": {"resample": "lanczos", "mode": "RGB"}}
+CHANNEL_RESIZE_SETTINGS = json.loads(os.getenv("CHANNEL_RESIZE_SETTINGS", "{}"))
+
+# How outputs are encoded. PNG profiles are print masters at the full print size, profiles with
+# max_side are previews scaled down to that longest side. The remaining keys go to Image.save.
+# Large PNGs are encoded in bands, which supports compress_level and dpi; a PNG profile with
+# any other Image.save option is encoded as one full frame instead.
+# ENCODER_PROFILES in the environment overrides keys of these or adds profiles, e.g.
+# {"png": {"compress_level": 9}, "webp_small": {"format": "WEBP", "extension": "webp", "quality": 60, "max_side": 1024}}
+ENCODER_PROFILES = {
+    "png_fast": {"format": "PNG", "extension": "png", "compress_level": 1, "dpi": (300, 300)},
+    "png": {"format": "PNG", "extension": "png", "compress_level": 6, "dpi": (300, 300)},
+    "png_optimized": {"format": "PNG", "extension": "png", "compress_level": 9, "dpi": (300, 300)},
+    "webp_preview": {"format": "WEBP", "extension": "webp", "quality": 80, "method": 4, "max_side": 2048},
+    "jpeg_preview": {"format": "JPEG", "extension": "jpg", "quality": 85, "optimize": True, "max_side": 2048}
+}
+for name, overrides in json.loads(os.getenv("ENCODER_PROFILES", "{}")).items():
+    ENCODER_PROFILES[name] = {**ENCODER_PROFILES.get(name, {}), **overrides}
+
+# Encoder profile of the copy each destination receives, the lossless print master goes to Dropbox
+OUTPUT_PROFILES = {
+    "dropbox": os.getenv("DROPBOX_OUTPUT_PROFILE", "png"),
+    "slack": os.getenv("SLACK_OUTPUT_PROFILE", "jpeg_preview")
+}
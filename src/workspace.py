@@ -0,0 +1,49 @@
+import os
+import uuid
+import shutil
+import datetime
+import tempfile
+
+__all__ = ["JobWorkspace"]
+
+# Point this at a tmpfs mount such as /dev/shm to keep job files in memory
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT") or None
+
+class JobWorkspace:
+    """
+        A scratch directory owned by a single job.
+        Every job gets its own inputs, outputs and models folders, and the whole tree is removed
+        when the job finishes, whether it succeeded or not.
+    """
+    folders = ("inputs", "outputs", "models")
+
+    def __init__(self, root=WORKSPACE_ROOT):
+        self.root = root
+        self.path = None
+
+    def __enter__(self):
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+
+        self.path = tempfile.mkdtemp(prefix="job_", dir=self.root)
+        for folder in self.folders:
+            os.mkdir(os.path.join(self.path, folder))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+        return False
+
+    def new_file(self, folder: str, ext: str, prefix=""):
+        """
+            Returns a path in the given folder with a name no other job or file in this job will use.
+            Names keep the timestamp the bot has always used so outputs still sort by time.
+        """
+        now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+        name = f"{prefix}{now}-{uuid.uuid4().hex[:8]}.{ext}"
+        return os.path.join(self.path, folder, name)
+
+    def cleanup(self):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None